@@ -0,0 +1,147 @@
+import json
+import os
+import sys
+import threading
+import time
+
+from metricas import registrar_tiempo
+
+# Calentamiento del proceso: al terminar la primera ejecución del script se lanza un hilo que importa las
+# dependencias pesadas (pandas, PIL, requests, nylas) y llena las cachés compartidas (catálogo,
+# índice de búsqueda, sesión HTTP, conexiones). Mientras tanto la página de inicio de sesión, que
+# no las necesita, se sirve enseguida. Si un usuario entra antes de que termine, espera en los
+# mismos bloqueos de cada módulo en lugar de repetir el trabajo.
+CALENTAR = os.getenv('WALLACORE_CALENTAR', '1') == '1'
+# Si se indica, al terminar el calentamiento se añade ahí una línea JSON con el informe de arranque
+RUTA_INFORME = os.getenv('WALLACORE_INFORME_ARRANQUE')
+
+DIRECTORIO_APP = os.path.dirname(os.path.abspath(__file__))
+
+_bloqueo = threading.Lock()
+_informe = {'pid': os.getpid(), 'estado': 'pendiente', 'fases': {}, 'errores': {}}
+
+
+# Función para obtener cuándo arrancó el proceso (solo en Linux; None si no se puede saber)
+def _inicio_proceso():
+    try:
+        with open('/proc/self/stat') as file:
+            campos = file.read().rsplit(')', 1)[1].split()
+        with open('/proc/stat') as file:
+            arranque_sistema = next(int(linea.split()[1]) for linea in file if linea.startswith('btime'))
+        return arranque_sistema + int(campos[19]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, StopIteration, AttributeError):
+        return None
+
+
+def _importar_modulos():
+    import catalogo  # pandas, pyarrow, PIL y requests (a través de miniaturas)
+    import busqueda
+
+
+def _cargar_catalogo():
+    import catalogo
+    catalogo.cargar_catalogo()
+
+
+def _construir_indice():
+    import busqueda
+    busqueda.obtener_indice()
+
+
+def _abrir_sesion_http():
+    import miniaturas
+    miniaturas.obtener_sesion()
+
+
+def _conectar_mensajes():
+    import mensajes
+    mensajes.conectar()
+
+
+def _preparar_correo():
+    import correo
+    correo.conectar()
+    if correo.TRANSPORTE_CORREO == 'nylas':
+        correo.obtener_cliente_nylas()
+
+
+# Fases del calentamiento, en orden
+FASES = [
+    ('importar', _importar_modulos),
+    ('catalogo', _cargar_catalogo),
+    ('indice', _construir_indice),
+    ('sesion_http', _abrir_sesion_http),
+    ('mensajes', _conectar_mensajes),
+]
+
+
+# Función para ejecutar las fases y medirlas; un fallo no detiene las siguientes
+def _calentar(fases):
+    # El hilo importa los módulos de la aplicación, que están junto a este. Se añade aunque ya esté:
+    # el ejecutor de scripts de Streamlit puede quitar su entrada al terminar el rerun.
+    sys.path.append(DIRECTORIO_APP)
+    inicio = time.perf_counter()
+    for nombre, fase in fases:
+        inicio_fase = time.perf_counter()
+        error = None
+        try:
+            fase()
+        except Exception as excepcion:
+            error = repr(excepcion)
+        duracion = time.perf_counter() - inicio_fase
+        registrar_tiempo(f'arranque.{nombre}', duracion)
+        with _bloqueo:
+            _informe['fases'][nombre] = duracion
+            if error:
+                _informe['errores'][nombre] = error
+    with _bloqueo:
+        _informe['calentamiento_s'] = time.perf_counter() - inicio
+        _informe['listo'] = time.time()
+        if _informe.get('inicio_proceso'):
+            # Tiempo desde que arrancó el proceso hasta tener todas las cachés llenas
+            _informe['listo_s'] = _informe['listo'] - _informe['inicio_proceso']
+        _informe['estado'] = 'listo'
+    if RUTA_INFORME:
+        with open(RUTA_INFORME, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(informe_arranque(), ensure_ascii=False) + '\n')
+
+
+# Función para lanzar el calentamiento, una sola vez por proceso. Con correo=True también se
+# prepara la cola de correo y el cliente de Nylas (solo la versión con avisos por correo).
+def iniciar_calentamiento(correo=False):
+    with _bloqueo:
+        if _informe['estado'] != 'pendiente':
+            return
+        _informe['inicio_proceso'] = _inicio_proceso()
+        _informe['primer_rerun'] = time.time()
+        if _informe['inicio_proceso']:
+            # Tiempo que tardó el proceso en ejecutar el script por primera vez (servidor e imports)
+            _informe['primer_rerun_s'] = _informe['primer_rerun'] - _informe['inicio_proceso']
+        if not CALENTAR:
+            _informe['estado'] = 'desactivado'
+            return
+        _informe['estado'] = 'calentando'
+    fases = FASES + [('correo', _preparar_correo)] if correo else FASES
+    threading.Thread(target=_calentar, args=(fases,), name='calentamiento', daemon=True).start()
+
+
+# Función para obtener una copia del informe de arranque del proceso
+def informe_arranque():
+    with _bloqueo:
+        informe = dict(_informe)
+        informe['fases'] = {nombre: round(segundos, 4) for nombre, segundos in _informe['fases'].items()}
+        informe['errores'] = dict(_informe['errores'])
+    return informe
+
+
+# Ejecutado directamente, mide un arranque en frío en primer plano e imprime el informe:
+#   python arranque.py [--correo]
+if __name__ == '__main__':
+    inicio = time.perf_counter()
+    import streamlit  # El coste de importar Streamlit también forma parte del arranque de un proceso
+    registrar_tiempo('arranque.streamlit', time.perf_counter() - inicio)
+    _informe['fases']['streamlit'] = time.perf_counter() - inicio
+    _informe['inicio_proceso'] = _inicio_proceso()
+    _informe['estado'] = 'calentando'
+    _calentar(FASES + [('correo', _preparar_correo)] if '--correo' in sys.argv else FASES)
+    print(json.dumps(informe_arranque(), ensure_ascii=False, indent=2))
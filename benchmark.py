@@ -0,0 +1,299 @@
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+from PIL import Image
+
+# Banco de pruebas con datos sintéticos: mide cuánto tardan las operaciones de la aplicación
+# según crece el catálogo y el historial de mensajes.
+#
+#   python benchmark.py                                   # 1k, 10k, 100k y 1M filas
+#   python benchmark.py --filas 1000 10000 --salida nuevo.json
+#   python benchmark.py --comparar base.json nuevo.json   # detectar regresiones entre versiones
+#
+# Cada tamaño se ejecuta en un proceso y un directorio temporal propios, de forma que las cachés
+# empiezan vacías y las mediciones en frío son reales. Las fotos se sirven desde un servidor HTTP
+# local con latencia configurable y los correos usan el transporte falso.
+TAMAÑOS = [1000, 10000, 100000, 1000000]
+DIRECTORIO_APP = os.path.dirname(os.path.abspath(__file__))
+USUARIO_PRINCIPAL = 'vendedor0@wallacore.test'
+
+PRODUCTOS = ['bicicleta', 'móvil', 'sofá', 'mesa', 'lámpara', 'guitarra', 'cámara', 'libro', 'chaqueta',
+             'zapatillas', 'patinete', 'consola', 'televisor', 'silla', 'reloj', 'mochila', 'portátil',
+             'altavoz', 'teclado', 'monitor']
+ADJETIVOS = ['rojo', 'azul', 'nuevo', 'usado', 'antiguo', 'grande', 'pequeño', 'eléctrico', 'plegable', 'vintage']
+PALABRAS = ['perfecto', 'estado', 'envío', 'incluido', 'poco', 'uso', 'garantía', 'original', 'caja', 'factura',
+            'negociable', 'urgente', 'regalo', 'funciona', 'bien', 'como', 'nuevo', 'precio', 'fijo', 'recogida']
+
+
+# Servidor de fotos local: responde siempre la misma imagen tras esperar la latencia configurada
+class ServidorFotos(BaseHTTPRequestHandler):
+    latencia = 0.0
+    imagen = b''
+
+    def do_GET(self):
+        time.sleep(self.latencia)
+        if self.headers.get('If-None-Match') == '"foto"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(self.imagen)))
+        self.send_header('ETag', '"foto"')
+        self.end_headers()
+        self.wfile.write(self.imagen)
+
+    def log_message(self, *args):
+        pass
+
+
+# Función para arrancar el servidor de fotos en segundo plano; devuelve su URL base
+def iniciar_servidor_fotos(latencia):
+    imagen = BytesIO()
+    Image.new('RGB', (400, 300), (200, 80, 40)).save(imagen, format='PNG')
+    ServidorFotos.latencia = latencia
+    ServidorFotos.imagen = imagen.getvalue()
+    servidor = ThreadingHTTPServer(('127.0.0.1', 0), ServidorFotos)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{servidor.server_address[1]}"
+
+
+# Función para generar catalogo.csv y mensajes.csv con `filas` filas cada uno
+def generar_datos(filas, url_fotos, semilla):
+    from catalogo import CABECERA
+    from mensajes import CABECERA_CSV, FORMATO_FECHA
+
+    aleatorio = random.Random(semilla)
+    vendedores = max(10, filas // 20)
+    with open('catalogo.csv', 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(CABECERA)
+        for i in range(filas):
+            vendedor = i % vendedores
+            writer.writerow([
+                f"{i:032x}", 'alta', f"vendedor{vendedor}", f"vendedor{vendedor}@wallacore.test",
+                f"{aleatorio.choice(PRODUCTOS)} {aleatorio.choice(ADJETIVOS)}",
+                ' '.join(aleatorio.choices(PALABRAS, k=aleatorio.randint(5, 40))),
+                f"{url_fotos}/foto/{i % 50}.png",
+                round(aleatorio.uniform(1, 1000), 2),
+            ])
+
+    # Uno de cada diez mensajes va al usuario principal, el que se usa para medir la bandeja
+    usuarios = max(10, filas // 50)
+    inicio = datetime(2024, 1, 1)
+    with open('mensajes.csv', 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(CABECERA_CSV)
+        for i in range(filas):
+            remitente = f"usuario{aleatorio.randrange(usuarios)}@wallacore.test"
+            destinatario = USUARIO_PRINCIPAL if i % 10 == 0 else f"vendedor{aleatorio.randrange(vendedores)}@wallacore.test"
+            writer.writerow([
+                (inicio + timedelta(minutes=i)).strftime(FORMATO_FECHA), remitente, destinatario,
+                f"{aleatorio.choice(PRODUCTOS)} {aleatorio.choice(ADJETIVOS)}",
+                ' '.join(aleatorio.choices(PALABRAS, k=aleatorio.randint(3, 20))),
+            ])
+
+
+# Función para medir una operación; `preparar` devuelve los argumentos de cada repetición y no se mide
+def medir(filas, operacion, funcion, repeticiones=1, preparar=None):
+    tiempos = []
+    for _ in range(repeticiones):
+        argumentos = preparar() if preparar else ()
+        inicio = time.perf_counter()
+        funcion(*argumentos)
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    resultado = {
+        'filas': filas,
+        'operacion': operacion,
+        'repeticiones': repeticiones,
+        'min_ms': round(min(tiempos), 3),
+        'mediana_ms': round(statistics.median(tiempos), 3),
+        'media_ms': round(statistics.mean(tiempos), 3),
+        'max_ms': round(max(tiempos), 3),
+    }
+    print(f"  {operacion:<32} mediana {resultado['mediana_ms']:>10.2f} ms", file=sys.stderr)
+    return resultado
+
+
+# Función para medir todas las operaciones con un tamaño; se ejecuta en el proceso hijo
+def ejecutar_tamaño(filas, repeticiones, latencia, semilla):
+    inicio = time.perf_counter()
+    generar_datos(filas, iniciar_servidor_fotos(latencia), semilla)
+    preparacion = {'filas': filas, 'generar_s': round(time.perf_counter() - inicio, 3)}
+
+    import busqueda
+    import catalogo
+    import correo
+    import mensajes
+    from streamlit.testing.v1 import AppTest
+
+    inicio = time.perf_counter()
+    if mensajes.MOTOR_MENSAJES != 'csv':
+        mensajes.conectar()  # Migra mensajes.csv a SQLite
+    preparacion['migrar_mensajes_s'] = round(time.perf_counter() - inicio, 3)
+
+    resultados = []
+    resultados.append(medir(filas, 'cargar_catalogo_frio', catalogo.cargar_catalogo))
+    catalogo._compactador.submit(lambda: None).result()  # Esperar a la instantánea en segundo plano
+
+    def recargar_catalogo():
+        catalogo.invalidar_catalogo()
+        catalogo.cargar_catalogo()
+
+    resultados.append(medir(filas, 'cargar_catalogo_recarga', recargar_catalogo, repeticiones))
+    resultados.append(medir(filas, 'cargar_catalogo', catalogo.cargar_catalogo, repeticiones))
+    resultados.append(medir(filas, 'construir_indice', busqueda.obtener_indice))
+    resultados.append(medir(filas, 'buscar', lambda: busqueda.buscar('bicicleta rojo'), repeticiones))
+    resultados.append(medir(filas, 'productos_de_vendedor',
+                            lambda: busqueda.productos_de_vendedor(USUARIO_PRINCIPAL), repeticiones))
+
+    # mostrar_productos se mide ejecutando la aplicación sin navegador, como un rerun de Streamlit
+    app = AppTest.from_file(os.path.join(DIRECTORIO_APP, 'wallacore.py'), default_timeout=600)
+    app.session_state.logged_in = True
+    app.session_state.usuario = 'vendedor0'
+    app.session_state.correo = USUARIO_PRINCIPAL
+    app.session_state.producto_seleccionado = None
+    app.session_state.vendedor_seleccionado = None
+    app.session_state.correo_vendedor = None
+    app.session_state.hilo_abierto = None
+    app.run()  # Primera ejecución: importaciones de la aplicación
+    resultados.append(medir(filas, 'rerun_lista_productos', app.run, repeticiones))
+    app.session_state[f"producto_{catalogo.cargar_catalogo().index[0]}"] = True
+    resultados.append(medir(filas, 'rerun_producto_abierto_frio', app.run))
+    resultados.append(medir(filas, 'rerun_producto_abierto', app.run, repeticiones))
+
+    resultados.append(medir(filas, 'cargar_mensajes',
+                            lambda: mensajes.cargar_mensajes(USUARIO_PRINCIPAL), repeticiones))
+    resultados.append(medir(filas, 'cargar_hilos',
+                            lambda: mensajes.cargar_hilos(USUARIO_PRINCIPAL, 20), repeticiones))
+    resultados.append(medir(filas, 'contar_mensajes_no_leidos',
+                            lambda: mensajes.contar_mensajes_no_leidos(USUARIO_PRINCIPAL), repeticiones))
+
+    # Con el aviso por correo activado, como en la versión de la aplicación con avisos
+    correo.configurar_transporte(correo.transporte_falso)
+    correo.activar_avisos()
+    resultados.append(medir(filas, 'enviar_mensaje', mensajes.enviar_mensaje, repeticiones,
+                            preparar=lambda: ('usuario1@wallacore.test', USUARIO_PRINCIPAL, 'bicicleta roja', 'Hola')))
+
+    ids = list(catalogo.cargar_catalogo().index)
+    aleatorio = random.Random(semilla)
+    resultados.append(medir(filas, 'eliminar_producto', catalogo.eliminar_producto, repeticiones,
+                            preparar=lambda: (ids.pop(aleatorio.randrange(len(ids))),)))
+
+    # Arranque en frío de un proceso nuevo con estos datos: importaciones y calentamiento de las cachés
+    catalogo._compactador.submit(lambda: None).result()
+    arranque = {}
+
+    def arrancar_proceso():
+        salida = subprocess.run([sys.executable, os.path.join(DIRECTORIO_APP, 'arranque.py')],
+                                capture_output=True, text=True, check=True).stdout
+        arranque.update(json.loads(salida))
+
+    resultados.append(medir(filas, 'arranque_proceso', arrancar_proceso))
+    preparacion['arranque_fases_s'] = arranque['fases']
+    return {'preparacion': preparacion, 'resultados': resultados}
+
+
+# Función para obtener el commit de la versión medida, si el código está en un repositorio git
+def version_codigo():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=DIRECTORIO_APP,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Función para ejecutar el banco de pruebas completo, un proceso hijo por tamaño
+def ejecutar(args):
+    informe = {
+        'version': version_codigo(),
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'plataforma': platform.platform(),
+        'parametros': {'repeticiones': args.repeticiones, 'latencia_fotos_ms': args.latencia_fotos,
+                       'motor_mensajes': args.motor_mensajes, 'semilla': args.semilla},
+        'preparacion': [],
+        'resultados': [],
+    }
+    # Sin calentamiento en segundo plano: competiría con las mediciones del propio proceso
+    entorno = dict(os.environ, WALLACORE_MOTOR_MENSAJES=args.motor_mensajes, WALLACORE_TRANSPORTE_CORREO='falso',
+                   WALLACORE_VENTANA_AVISOS='0', WALLACORE_CALENTAR='0')
+    for filas in args.filas:
+        print(f"{filas} filas", file=sys.stderr)
+        with tempfile.TemporaryDirectory(prefix='wallacore-benchmark-') as directorio:
+            ruta_resultado = os.path.join(directorio, 'resultado.json')
+            subprocess.run([sys.executable, os.path.abspath(__file__), '--hijo', str(filas),
+                            '--repeticiones', str(args.repeticiones), '--latencia-fotos', str(args.latencia_fotos),
+                            '--semilla', str(args.semilla), '--resultado', ruta_resultado],
+                           cwd=directorio, env=entorno, check=True)
+            with open(ruta_resultado, 'r', encoding='utf-8') as file:
+                resultado = json.load(file)
+        informe['preparacion'].append(resultado['preparacion'])
+        informe['resultados'].extend(resultado['resultados'])
+
+    if args.salida:
+        with open(args.salida, 'w', encoding='utf-8') as file:
+            json.dump(informe, file, indent=2, ensure_ascii=False)
+    else:
+        json.dump(informe, sys.stdout, indent=2, ensure_ascii=False)
+        print()
+
+
+# Función para comparar dos informes; devuelve True si alguna mediana empeora más que el umbral
+def comparar(ruta_base, ruta_nueva, umbral):
+    with open(ruta_base, 'r', encoding='utf-8') as file:
+        base = {(r['filas'], r['operacion']): r for r in json.load(file)['resultados']}
+    with open(ruta_nueva, 'r', encoding='utf-8') as file:
+        nuevos = json.load(file)['resultados']
+    regresion = False
+    print(f"{'filas':>8} {'operación':<32} {'base ms':>10} {'nuevo ms':>10} {'ratio':>7}")
+    for resultado in nuevos:
+        anterior = base.get((resultado['filas'], resultado['operacion']))
+        if anterior is None:
+            continue
+        ratio = resultado['mediana_ms'] / anterior['mediana_ms'] if anterior['mediana_ms'] else float('inf')
+        marca = ''
+        if ratio > umbral:
+            marca = '  <- regresión'
+            regresion = True
+        print(f"{resultado['filas']:>8} {resultado['operacion']:<32} {anterior['mediana_ms']:>10.2f} "
+              f"{resultado['mediana_ms']:>10.2f} {ratio:>7.2f}{marca}")
+    return regresion
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Banco de pruebas de Wallacore con datos sintéticos")
+    parser.add_argument('--filas', type=int, nargs='+', default=TAMAÑOS, help="Tamaños a medir")
+    parser.add_argument('--repeticiones', type=int, default=5)
+    parser.add_argument('--latencia-fotos', type=float, default=50, help="Latencia del servidor de fotos (ms)")
+    parser.add_argument('--motor-mensajes', choices=['sqlite', 'csv'], default='sqlite')
+    parser.add_argument('--semilla', type=int, default=1)
+    parser.add_argument('--salida', help="Fichero JSON de resultados (por defecto, la salida estándar)")
+    parser.add_argument('--comparar', nargs=2, metavar=('BASE', 'NUEVO'), help="Comparar dos ficheros de resultados")
+    parser.add_argument('--umbral', type=float, default=1.25, help="Ratio a partir del cual se marca una regresión")
+    parser.add_argument('--hijo', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--resultado', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.comparar:
+        sys.exit(1 if comparar(*args.comparar, args.umbral) else 0)
+    elif args.hijo:
+        resultado = ejecutar_tamaño(args.hijo, args.repeticiones, args.latencia_fotos / 1000, args.semilla)
+        with open(args.resultado, 'w', encoding='utf-8') as file:
+            json.dump(resultado, file)
+        os._exit(0)  # Sin esperar a los hilos de fondo (trabajador de correo, servidor de fotos)
+    else:
+        ejecutar(args)
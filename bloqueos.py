@@ -0,0 +1,27 @@
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+# Función para bloquear un fichero de datos entre hilos y procesos.
+# Se bloquea un fichero '.lock' aparte para que reemplazar el de datos (os.replace) no rompa el bloqueo.
+@contextmanager
+def bloqueo_fichero(ruta, compartido=False):
+    with open(ruta + '.lock', 'a+b') as file:
+        if fcntl:
+            fcntl.flock(file.fileno(), fcntl.LOCK_SH if compartido else fcntl.LOCK_EX)
+        else:
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)  # En Windows el bloqueo siempre es exclusivo
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+            else:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
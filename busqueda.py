@@ -0,0 +1,284 @@
+import bisect
+import math
+import re
+import threading
+import unicodedata
+
+import catalogo
+from metricas import contar, cronometrar
+
+# Órdenes disponibles para los resultados
+ORDENES = {
+    'publicacion': "Orden de publicación",
+    'recientes': "Más recientes primero",
+    'precio_asc': "Precio: de menor a mayor",
+    'precio_desc': "Precio: de mayor a menor",
+}
+
+# Índice en memoria del catálogo, compartido por todas las sesiones del proceso:
+#   tokens: {token: {ids}}, índice invertido sobre Producto y Descripción
+#   vocabulario: tokens ordenados, para buscar por prefijo
+#   precios: [(precio, id)] ordenado, para rangos y orden por precio
+#   vendedores: {vendedor: {ids}}; lista_vendedores: los que tienen productos, ordenados (None si hay que recalcularla)
+#   correos: {correo del vendedor: {ids}}, para "Mis productos"
+#   orden: {id: secuencia de publicación}
+#   datos: {id: (tokens, precio, vendedor, correo)}, para poder desindexar
+#   version: versión del catálogo indexada; df: el catálogo de esa versión (None hasta que se pida)
+_bloqueo = threading.RLock()
+_indice = {'version': None, 'df': None}
+# Reconstrucción del índice en segundo plano. Mientras dura, las búsquedas usan el índice anterior
+# y los avisos del catálogo se guardan en 'filas' para aplicarlos al índice nuevo al instalarlo.
+_reconstruccion = {'hilo': None, 'version': None, 'filas': []}
+
+
+# Función para normalizar un texto: minúsculas y sin tildes
+def normalizar(texto):
+    texto = texto.lower()
+    if texto.isascii():
+        return texto
+    return _DIACRITICOS.sub('', unicodedata.normalize('NFKD', texto))
+
+
+_DIACRITICOS = re.compile('[\u0300-\u036f]')
+_PALABRA = re.compile(r'\w+')
+
+
+def tokenizar(*textos):
+    tokens = set()
+    for texto in textos:
+        if isinstance(texto, str):
+            tokens.update(_PALABRA.findall(normalizar(texto)))
+    return tokens
+
+
+def _precio_valido(precio):
+    try:
+        return not math.isnan(float(precio))
+    except (TypeError, ValueError):
+        return False
+
+
+# Función para añadir un producto al índice. En la construcción masiva (masivo=True)
+# las listas ordenadas se ordenan al final en lugar de insertar en su sitio.
+def _indexar(indice, id_producto, tokens, vendedor, correo, precio, masivo=False):
+    for token in tokens:
+        if token not in indice['tokens']:
+            indice['tokens'][token] = set()
+            if not masivo:
+                bisect.insort(indice['vocabulario'], token)
+        indice['tokens'][token].add(id_producto)
+    precio = float(precio) if _precio_valido(precio) else None
+    if precio is not None:
+        if masivo:
+            indice['precios'].append((precio, id_producto))
+        else:
+            bisect.insort(indice['precios'], (precio, id_producto))
+    del_vendedor = indice['vendedores'].setdefault(vendedor, set())
+    if not del_vendedor:
+        indice['lista_vendedores'] = None
+    del_vendedor.add(id_producto)
+    indice['correos'].setdefault(correo, set()).add(id_producto)
+    if id_producto not in indice['orden']:
+        indice['secuencia'] += 1
+        indice['orden'][id_producto] = indice['secuencia']
+    indice['datos'][id_producto] = (set(tokens), precio, vendedor, correo)
+
+
+def _desindexar(indice, id_producto, conservar_orden=False):
+    tokens, precio, vendedor, correo = indice['datos'].pop(id_producto)
+    for token in tokens:
+        indice['tokens'][token].discard(id_producto)
+    if precio is not None:
+        posicion = bisect.bisect_left(indice['precios'], (precio, id_producto))
+        del indice['precios'][posicion]
+    indice['vendedores'][vendedor].discard(id_producto)
+    if not indice['vendedores'][vendedor]:
+        indice['lista_vendedores'] = None
+    indice['correos'][correo].discard(id_producto)
+    if not conservar_orden:
+        del indice['orden'][id_producto]
+
+
+# Función para construir el índice completo a partir del catálogo
+@cronometrar('busqueda.construir')
+def _construir(df, version):
+    indice = {'version': version, 'df': df, 'tokens': {}, 'vocabulario': [], 'precios': [], 'vendedores': {},
+              'lista_vendedores': None, 'correos': {}, 'orden': {}, 'secuencia': 0, 'datos': {}}
+    # Los textos se normalizan y se parten en tokens de una vez para todo el catálogo
+    textos = df['Producto'].fillna('').astype(str) + ' ' + df['Descripción'].fillna('').astype(str)
+    textos = textos.str.lower().str.normalize('NFKD').str.replace(_DIACRITICOS.pattern, '', regex=True)
+    tokens = textos.str.findall(_PALABRA.pattern)
+    for fila in zip(df.index.tolist(), tokens.tolist(), df['Vendedor'].tolist(), df['Correo Vendedor'].tolist(),
+                    df['Precio'].tolist()):
+        _indexar(indice, *fila, masivo=True)
+    indice['vocabulario'] = sorted(indice['tokens'])
+    indice['precios'].sort()
+    return indice
+
+
+# Función para aplicar al índice altas, ediciones y bajas del registro del catálogo
+def _aplicar_filas(indice, filas):
+    for id_producto, operacion, vendedor, correo, producto, descripcion, _, precio in filas:
+        if id_producto in indice['datos']:
+            _desindexar(indice, id_producto, conservar_orden=operacion == 'edicion')
+        if operacion != 'baja':
+            _indexar(indice, id_producto, tokenizar(producto, descripcion), vendedor, correo, precio)
+
+
+# Oyente del catálogo: aplica las altas, ediciones y bajas sin reconstruir el índice
+def _al_cambiar_catalogo(anterior, nueva, filas):
+    with _bloqueo:
+        if _reconstruccion['version'] == anterior:
+            _reconstruccion['filas'].extend(filas)
+            _reconstruccion['version'] = nueva
+        if _indice['version'] != anterior:
+            return  # El índice ya estaba desfasado; se está reconstruyendo o se reconstruirá
+        _aplicar_filas(_indice, filas)
+        _indice['version'] = nueva
+        _indice['df'] = None  # El catálogo de la nueva versión se pide al usarlo, no en cada escritura
+
+
+catalogo.suscribir(_al_cambiar_catalogo)
+
+
+# Función para reconstruir el índice en segundo plano hasta que corresponda al catálogo actual.
+# Si una escritura se cuela entre la carga del catálogo y el registro de su versión, el índice
+# instalado queda desfasado y se vuelve a construir.
+def _reconstruir():
+    try:
+        while True:
+            df, version = catalogo.cargar_catalogo_versionado()
+            with _bloqueo:
+                if _indice['version'] is not None and _indice['version'] >= version:
+                    return
+                _reconstruccion['version'] = version
+                _reconstruccion['filas'] = []
+            nuevo = _construir(df, version)
+            with _bloqueo:
+                _aplicar_filas(nuevo, _reconstruccion['filas'])
+                if _reconstruccion['version'] != version:
+                    nuevo['version'] = _reconstruccion['version']
+                    nuevo['df'] = None
+                _reconstruccion['version'] = None
+                _reconstruccion['filas'] = []
+                _indice.clear()
+                _indice.update(nuevo)
+    finally:
+        with _bloqueo:
+            _reconstruccion['hilo'] = None
+
+
+def _programar_reconstruccion():
+    if _reconstruccion['hilo'] is None:
+        _reconstruccion['hilo'] = threading.Thread(target=_reconstruir, name='indice-busqueda', daemon=True)
+        _reconstruccion['hilo'].start()
+
+
+# Función para obtener el índice del catálogo actual. La primera vez se construye aquí; después, si el
+# catálogo se ha releído entero, se reconstruye en segundo plano y mientras tanto se sigue usando el
+# anterior (marcado como desfasado) con el catálogo nuevo.
+# El catálogo se carga fuera de _bloqueo: sus escrituras avisan al índice con su propio bloqueo cogido.
+def obtener_indice():
+    while True:
+        df, version = catalogo.cargar_catalogo_versionado()
+        with _bloqueo:
+            if _indice['version'] is not None and _indice['version'] > version:
+                continue  # Una escritura ya ha puesto el índice por delante de este catálogo
+            if _indice['version'] is None:
+                _indice.update(_construir(df, version))
+            elif _indice['version'] != version:
+                contar('busqueda.indice_desfasado')
+                _programar_reconstruccion()
+                return dict(_indice, df=df, desfasado=True)
+            elif _indice['df'] is None:
+                _indice['df'] = df
+            return _indice
+
+
+# Función para consultar el índice junto con el catálogo de su misma versión
+def _consultar(consulta):
+    while True:
+        indice = obtener_indice()
+        with _bloqueo:
+            if indice['df'] is not None:  # Si no, una escritura se ha colado entre medias
+                return consulta(indice)
+
+
+# Función para devolver los IDs encontrados o, con filas=True, sus filas del catálogo.
+# Un índice desfasado puede tener productos que ya no están en el catálogo: se descartan.
+def _resultado(indice, ids, filas):
+    if indice.get('desfasado'):
+        ids = [id_producto for id_producto in ids if id_producto in indice['df'].index]
+    return indice['df'].loc[ids] if filas else ids
+
+
+# Función para obtener los productos que contienen un token o una palabra que empieza por él
+def _buscar_token(indice, token):
+    vocabulario = indice['vocabulario']
+    encontrados = set()
+    posicion = bisect.bisect_left(vocabulario, token)
+    while posicion < len(vocabulario) and vocabulario[posicion].startswith(token):
+        encontrados |= indice['tokens'][vocabulario[posicion]]
+        posicion += 1
+    return encontrados
+
+
+# Función para obtener los IDs de los productos que cumplen los filtros, en el orden pedido (con _bloqueo cogido)
+def _buscar_ids(indice, texto, precio_min, precio_max, vendedor, orden):
+    candidatos = None  # None significa "todos los productos"
+    for token in tokenizar(texto):
+        encontrados = _buscar_token(indice, token)
+        candidatos = encontrados if candidatos is None else candidatos & encontrados
+        if not candidatos:
+            return []
+    if vendedor:
+        del_vendedor = indice['vendedores'].get(vendedor, set())
+        candidatos = set(del_vendedor) if candidatos is None else candidatos & del_vendedor
+
+    por_precio = orden in ('precio_asc', 'precio_desc')
+    precios = indice['precios']
+    if precio_min is not None or precio_max is not None or por_precio:
+        inicio = 0 if precio_min is None else bisect.bisect_left(precios, (precio_min,))
+        fin = len(precios) if precio_max is None else bisect.bisect_right(precios, (precio_max, chr(0x10ffff)))
+        tramo = [id_producto for _, id_producto in precios[inicio:fin]
+                 if candidatos is None or id_producto in candidatos]
+        if por_precio:
+            return tramo[::-1] if orden == 'precio_desc' else tramo
+        candidatos = set(tramo)
+
+    if candidatos is None:
+        resultado = list(indice['df'].index)
+    else:
+        resultado = sorted(candidatos, key=indice['orden'].__getitem__)
+    return resultado[::-1] if orden == 'recientes' else resultado
+
+
+# Función para buscar productos; devuelve sus IDs en el orden pedido o, con filas=True, sus filas.
+# Las filas salen del catálogo del propio índice: otro cargar_catalogo() puede devolver uno más
+# antiguo, sin los productos publicados entretanto desde otra sesión o proceso.
+@cronometrar('busqueda.buscar')
+def buscar(texto='', precio_min=None, precio_max=None, vendedor=None, orden='publicacion', filas=False):
+    def consulta(indice):
+        ids = _buscar_ids(indice, texto, precio_min, precio_max, vendedor, orden)
+        return _resultado(indice, ids, filas)
+    return _consultar(consulta)
+
+
+# Función para listar los vendedores con productos a la venta. La lista se guarda en el índice hasta
+# que un vendedor gana su primer producto o pierde el último; es compartida, no debe modificarse.
+def listar_vendedores():
+    indice = obtener_indice()
+    with _bloqueo:
+        if indice['lista_vendedores'] is None:
+            indice['lista_vendedores'] = sorted(vendedor for vendedor, ids in indice['vendedores'].items()
+                                                if ids and isinstance(vendedor, str))
+        return indice['lista_vendedores']
+
+
+# Función para obtener los productos de un vendedor (por su correo), en orden de publicación;
+# con filas=True devuelve sus filas del catálogo del índice, como buscar()
+def productos_de_vendedor(correo, filas=False):
+    def consulta(indice):
+        ids = sorted(indice['correos'].get(correo, ()), key=indice['orden'].__getitem__)
+        return _resultado(indice, ids, filas)
+    return _consultar(consulta)
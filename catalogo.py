@@ -0,0 +1,457 @@
+import csv
+import io
+import itertools
+import json
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    from pyarrow import feather
+except ImportError:  # Sin pyarrow el catálogo se lee siempre del CSV
+    feather = None
+
+from bloqueos import bloqueo_fichero
+from metricas import contar, cronometrar
+from miniaturas import encolar_miniatura
+
+RUTA_CATALOGO = os.getenv('WALLACORE_CATALOGO', 'catalogo.csv')
+COLUMNAS_PRODUCTO = ['Vendedor', 'Correo Vendedor', 'Producto', 'Descripción', 'Foto', 'Precio']
+CABECERA = ['ID', 'Operación'] + COLUMNAS_PRODUCTO
+
+# El catálogo es un registro de solo añadir: cada fila es una operación sobre un producto.
+# 'alta' crea el producto, 'edicion' guarda sus nuevos valores y 'baja' es una lápida.
+# La compactación reescribe el fichero dejando solo el alta de los productos vigentes.
+COMPACTAR_MINIMO = int(os.getenv('WALLACORE_COMPACTAR_MINIMO', '500'))  # Registros obsoletos
+COMPACTAR_PROPORCION = float(os.getenv('WALLACORE_COMPACTAR_PROPORCION', '0.3'))
+
+# Instantánea columnar (Arrow/Feather sin comprimir) de los productos vigentes.
+# Se abre con memory map, así que los procesos comparten sus páginas, y solo hay que
+# leer como texto la cola del CSV escrita después de generarla.
+RUTA_INSTANTANEA = os.getenv('WALLACORE_INSTANTANEA', 'catalogo.feather')
+USAR_INSTANTANEA = feather is not None and os.getenv('WALLACORE_USAR_INSTANTANEA', '1') == '1'
+INSTANTANEA_COLA = int(os.getenv('WALLACORE_INSTANTANEA_COLA', str(1024 * 1024)))  # Bytes de CSV sin instantánea
+
+# Caché del catálogo compartida por todas las sesiones del proceso.
+# Se identifica por la fecha de modificación y el tamaño del fichero, así que cada proceso ve las
+# escrituras de los demás; 'inodo' y 'bytes' indican hasta dónde se ha leído para leer solo lo nuevo.
+# Las escrituras no copian el catálogo: se anotan junto a 'base' como altas {id: valores},
+# ediciones {id: valores} y bajas {ids}, y 'df' se calcula de nuevo solo cuando alguien lo pide.
+# 'version' cambia con cada modificación del contenido.
+_bloqueo = threading.RLock()
+_cache = {'firma': None, 'base': None, 'altas': {}, 'ediciones': {}, 'bajas': set(), 'df': None,
+          'version': 0, 'registros': 0, 'inodo': None, 'bytes': 0}
+_versiones = itertools.count(1)
+# Cambios pendientes a partir de los cuales se incorporan a 'base'
+CAMBIOS_SIN_PLEGAR = int(os.getenv('WALLACORE_CAMBIOS_SIN_PLEGAR', '1000'))
+_compactador = ThreadPoolExecutor(max_workers=1, thread_name_prefix='compactacion')
+_compactacion_pendiente = threading.Event()
+
+# Funciones avisadas cuando la caché cambia por una escritura de este proceso
+_oyentes = []
+
+
+# Función para obtener la firma (mtime, tamaño) del fichero del catálogo
+def _firma():
+    try:
+        stat = os.stat(RUTA_CATALOGO)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+# Función para generar el identificador estable de un producto
+def _nuevo_id():
+    return uuid.uuid4().hex
+
+
+# Función para reemplazar el fichero del catálogo de forma atómica
+def _reescribir(df):
+    temporal = f"{RUTA_CATALOGO}.{os.getpid()}.tmp"
+    df.to_csv(temporal, index=False, encoding='utf-8')
+    os.replace(temporal, RUTA_CATALOGO)
+
+
+# Función para crear el catálogo o pasarlo del formato antiguo (sin ID) al registro de operaciones
+def _migrar_formato_antiguo():
+    if not os.path.exists(RUTA_CATALOGO):
+        with bloqueo_fichero(RUTA_CATALOGO):
+            if not os.path.exists(RUTA_CATALOGO):
+                with open(RUTA_CATALOGO, 'w', newline='', encoding='utf-8') as file:
+                    csv.writer(file).writerow(CABECERA)
+        return
+    with open(RUTA_CATALOGO, 'r', encoding='utf-8') as file:
+        if next(csv.reader(file), [])[:1] == ['ID']:
+            return
+    with bloqueo_fichero(RUTA_CATALOGO):
+        df = pd.read_csv(RUTA_CATALOGO, encoding='utf-8')
+        if 'ID' in df.columns:
+            return  # Ya lo ha migrado otro proceso
+        df.insert(0, 'ID', [_nuevo_id() for _ in range(len(df))])
+        df.insert(1, 'Operación', 'alta')
+        _reescribir(df)
+
+
+# Función para obtener los productos vigentes a partir del registro de operaciones.
+# Cada producto conserva la posición de su alta y los valores de su última operación.
+def _aplicar_registro(registro):
+    orden = registro['ID'].drop_duplicates()
+    vigentes = registro.drop_duplicates('ID', keep='last').set_index('ID').loc[orden]
+    vigentes = vigentes[vigentes['Operación'] != 'baja']
+    return vigentes.drop(columns='Operación')
+
+
+# Función para leer la instantánea si corresponde al fichero actual del catálogo.
+# Devuelve (productos vigentes, registros, bytes del CSV que cubre) o None.
+def _leer_instantanea(stat):
+    if not USAR_INSTANTANEA:
+        return None
+    try:
+        tabla = feather.read_table(RUTA_INSTANTANEA, memory_map=True)
+        meta = json.loads(tabla.schema.metadata[b'wallacore'])
+    except (OSError, KeyError, ValueError, TypeError, pa.ArrowException):
+        return None
+    # La compactación reemplaza el fichero (otro inodo); un fichero más corto tampoco es el mismo registro
+    if meta['inodo'] != stat.st_ino or meta['bytes'] > stat.st_size:
+        return None
+    return tabla.to_pandas().set_index('ID'), meta['registros'], meta['bytes']
+
+
+# Función para guardar la instantánea de los productos vigentes del catálogo
+def _guardar_instantanea(vigentes, registros, stat):
+    try:
+        if os.stat(RUTA_CATALOGO).st_ino != stat.st_ino:
+            return  # El catálogo se ha compactado mientras tanto
+        tabla = pa.Table.from_pandas(vigentes.reset_index(), preserve_index=False)
+        meta = {'inodo': stat.st_ino, 'bytes': stat.st_size, 'registros': registros}
+        tabla = tabla.replace_schema_metadata({**(tabla.schema.metadata or {}), b'wallacore': json.dumps(meta)})
+        temporal = f"{RUTA_INSTANTANEA}.{os.getpid()}.tmp"
+        feather.write_feather(tabla, temporal, compression='uncompressed')
+        os.replace(temporal, RUTA_INSTANTANEA)
+    except (OSError, pa.ArrowException):
+        pass  # Sin instantánea el catálogo se sigue leyendo del CSV
+
+
+# Función para leer los registros escritos en el catálogo entre dos posiciones del fichero
+def _leer_cola(file, desde, hasta):
+    file.seek(desde)
+    datos = file.read(hasta - desde)
+    if not datos:
+        return pd.DataFrame(columns=CABECERA)
+    return pd.read_csv(io.BytesIO(datos), encoding='utf-8', header=None, names=CABECERA, dtype={'ID': str})
+
+
+# Función para aplicar sobre los productos vigentes los registros escritos después.
+# Equivale a _aplicar_registro sobre el registro completo, pero solo recorre los registros nuevos.
+def _aplicar_cola(vigentes, registro):
+    ultimos = registro.drop_duplicates('ID', keep='last').set_index('ID')
+    bajas = ultimos.index[ultimos['Operación'] == 'baja']
+    ultimos = ultimos[ultimos['Operación'] != 'baja'].drop(columns='Operación')
+    nuevos = [id_producto for id_producto in registro['ID'].drop_duplicates()
+              if id_producto in ultimos.index and id_producto not in vigentes.index]
+    if vigentes.empty:
+        return ultimos.loc[nuevos]
+    df = vigentes.drop(bajas.intersection(vigentes.index))
+    editados = ultimos.index.intersection(df.index)
+    if len(editados):
+        df.loc[editados, COLUMNAS_PRODUCTO] = ultimos.loc[editados, COLUMNAS_PRODUCTO]
+    return pd.concat([df, ultimos.loc[nuevos]]) if nuevos else df
+
+
+# Función para pasar los registros leídos al formato de filas que reciben los oyentes
+def _filas_registro(registro):
+    return registro.astype(object).where(registro.notna(), None).values.tolist()
+
+
+# Función para leer el catálogo con la firma que le corresponde.
+# Parte de la instantánea si es válida y aplica encima la cola del CSV; si no, lee el CSV entero.
+# Devuelve (firma, productos vigentes, número de registros, stat del fichero leído).
+@cronometrar('catalogo.leer')
+def _leer_catalogo():
+    with bloqueo_fichero(RUTA_CATALOGO, compartido=True):
+        firma = _firma()
+        stat = os.stat(RUTA_CATALOGO)
+        instantanea = _leer_instantanea(stat)
+        if instantanea is None:
+            registro = pd.read_csv(RUTA_CATALOGO, encoding='utf-8', dtype={'ID': str})
+            contar('catalogo.filas_leidas', len(registro))
+            vigentes, registros, cola = _aplicar_registro(registro), len(registro), stat.st_size
+        else:
+            contar('catalogo.instantanea_usada')
+            vigentes, registros, cubiertos = instantanea
+            cola = stat.st_size - cubiertos
+            if cola:
+                with open(RUTA_CATALOGO, 'rb') as file:
+                    registro = _leer_cola(file, cubiertos, stat.st_size)
+                contar('catalogo.filas_leidas', len(registro))
+                registros += len(registro)
+                vigentes = _aplicar_cola(vigentes, registro)
+    if USAR_INSTANTANEA and (instantanea is None or cola >= INSTANTANEA_COLA):
+        _compactador.submit(_guardar_instantanea, vigentes, registros, stat)
+    return firma, vigentes, registros, stat
+
+
+# Función para poner al día la caché con lo que otros procesos han añadido al catálogo,
+# leyendo solo a partir de la posición hasta la que ya estaba leído.
+# Devuelve False si el fichero se ha reemplazado (compactación) y hay que leerlo entero.
+@cronometrar('catalogo.leer_cola')
+def _refrescar_cola():
+    with bloqueo_fichero(RUTA_CATALOGO, compartido=True):
+        try:
+            with open(RUTA_CATALOGO, 'rb') as file:
+                stat = os.fstat(file.fileno())
+                if stat.st_ino != _cache['inodo'] or stat.st_size < _cache['bytes']:
+                    return False
+                registro = _leer_cola(file, _cache['bytes'], stat.st_size)
+        except FileNotFoundError:
+            return False
+    contar('catalogo.filas_leidas', len(registro))
+    _cache['firma'] = (stat.st_mtime_ns, stat.st_size)
+    _cache['bytes'] = stat.st_size
+    if len(registro):
+        filas = _filas_registro(registro)
+        anterior = _cache['version']
+        _aplicar_filas(filas)
+        _cache['registros'] += len(registro)
+        _notificar(anterior, _cache['version'], filas)
+        _programar_compactacion()
+    return True
+
+
+# Función para registrar un índice que se mantiene al día con las escrituras del catálogo.
+# El oyente recibe (versión anterior, versión nueva, filas escritas en el registro), tanto
+# para las escrituras de este proceso como para las de otros procesos que se leen después;
+# si el catálogo se relee entero (otra versión sin aviso), debe reconstruirse él mismo.
+def suscribir(oyente):
+    _oyentes.append(oyente)
+
+
+def _notificar(anterior, nuevo, filas):
+    for oyente in _oyentes:
+        oyente(anterior, nuevo, filas)
+
+
+# Función para descartar la caché y forzar la relectura del fichero
+def invalidar_catalogo():
+    with _bloqueo:
+        _cache['firma'] = None
+        _cache['base'] = None
+        _cache['df'] = None
+
+
+# Función para partir de un catálogo completo, sin cambios pendientes
+def _nueva_base(vigentes):
+    _cache['base'] = _cache['df'] = vigentes
+    _cache['altas'], _cache['ediciones'], _cache['bajas'] = {}, {}, set()
+    _cache['version'] = next(_versiones)
+
+
+def _vigente(id_producto):
+    return id_producto in _cache['altas'] or (
+        id_producto in _cache['base'].index and id_producto not in _cache['bajas'])
+
+
+def _num_vigentes():
+    return len(_cache['base']) - len(_cache['bajas']) + len(_cache['altas'])
+
+
+# Función para aplicar a la caché operaciones del registro ([ID, operación, valores...]).
+# Cada operación cuesta lo mismo sea cual sea el tamaño del catálogo: solo se anota junto a la base.
+def _aplicar_filas(filas):
+    for id_producto, operacion, *valores in filas:
+        if operacion == 'baja':
+            if _cache['altas'].pop(id_producto, None) is None and id_producto in _cache['base'].index:
+                _cache['bajas'].add(id_producto)
+            _cache['ediciones'].pop(id_producto, None)
+        elif id_producto in _cache['altas'] or id_producto not in _cache['base'].index:
+            _cache['altas'][id_producto] = valores
+        else:
+            # Igual que _aplicar_registro: el producto conserva su posición y toma los últimos valores
+            _cache['bajas'].discard(id_producto)
+            _cache['ediciones'][id_producto] = valores
+    _cache['df'] = None
+    _cache['version'] = next(_versiones)
+    if len(_cache['altas']) + len(_cache['ediciones']) + len(_cache['bajas']) > CAMBIOS_SIN_PLEGAR:
+        # El contenido no cambia, así que tampoco la versión
+        _cache['base'] = _materializar()
+        _cache['altas'], _cache['ediciones'], _cache['bajas'] = {}, {}, set()
+
+
+# Función para obtener el catálogo con los cambios pendientes aplicados; se calcula una vez por versión.
+# Las posiciones se buscan en el índice de la base, que ya tiene su tabla hash construida.
+def _materializar():
+    if _cache['df'] is None:
+        base = df = _cache['base']
+        if _cache['ediciones']:
+            df = base.copy()
+            posiciones = base.index.get_indexer(list(_cache['ediciones']))
+            for posicion, valores in zip(posiciones, _cache['ediciones'].values()):
+                df.iloc[posicion] = pd.Series(valores, index=COLUMNAS_PRODUCTO, dtype=object)
+        if _cache['bajas']:
+            vigentes = np.ones(len(base), dtype=bool)
+            vigentes[base.index.get_indexer(list(_cache['bajas']))] = False
+            df = df[vigentes]
+        if _cache['altas']:
+            altas = pd.DataFrame(list(_cache['altas'].values()), columns=COLUMNAS_PRODUCTO,
+                                 index=pd.Index(list(_cache['altas']), name='ID'))
+            df = pd.concat([df, altas]) if len(df) else altas
+        _cache['df'] = df
+    return _cache['df']
+
+
+# Función para comparar dos catálogos sin tener en cuenta el tipo de las columnas: las altas en
+# memoria guardan None y objetos donde la lectura del fichero deja NaN y columnas numéricas
+def _mismo_contenido(a, b):
+    if not a.index.equals(b.index):
+        return False
+    return all(a[columna].astype(object).where(a[columna].notna(), None).equals(
+        b[columna].astype(object).where(b[columna].notna(), None)) for columna in COLUMNAS_PRODUCTO)
+
+
+# Función para poner la caché al día con el fichero, leyendo solo lo nuevo siempre que se pueda
+def _poner_al_dia():
+    firma = _firma()
+    if _cache['base'] is not None and _cache['firma'] == firma:
+        contar('catalogo.cache_aciertos')
+        return
+    if _cache['base'] is None or not _refrescar_cola():
+        _migrar_formato_antiguo()
+        anterior = None if _cache['base'] is None else _materializar()
+        firma, vigentes, _cache['registros'], stat = _leer_catalogo()
+        if anterior is not None and _mismo_contenido(vigentes, anterior):
+            # Mismo contenido (compactado por otro proceso, instantánea nueva...): se conserva la
+            # versión para que el índice de búsqueda no se reconstruya
+            _cache['base'] = _cache['df'] = vigentes
+            _cache['altas'], _cache['ediciones'], _cache['bajas'] = {}, {}, set()
+        else:
+            _nueva_base(vigentes)
+        _cache['firma'] = firma
+        _cache['inodo'] = stat.st_ino
+        _cache['bytes'] = stat.st_size
+
+
+# Función para cargar el catálogo de productos, indexado por ID
+# El DataFrame devuelto es compartido: no debe modificarse en el sitio.
+def cargar_catalogo():
+    with _bloqueo:
+        _poner_al_dia()
+        return _materializar()
+
+
+# Función para cargar el catálogo junto con su versión (la que reciben los oyentes)
+def cargar_catalogo_versionado():
+    with _bloqueo:
+        _poner_al_dia()
+        return _materializar(), _cache['version']
+
+
+# Función para tratar los textos vacíos como valores ausentes, igual que pd.read_csv
+def _sin_vacios(valores):
+    return [None if valor == '' else valor for valor in valores]
+
+
+# Función para añadir operaciones al registro y aplicarlas también a la caché
+def _añadir_registros(filas):
+    with _bloqueo:
+        _poner_al_dia()  # Asegura el formato del fichero y una caché al día
+        with bloqueo_fichero(RUTA_CATALOGO):
+            firma_previa = _firma()
+            with open(RUTA_CATALOGO, 'a', newline='', encoding='utf-8') as file:
+                writer = csv.writer(file)
+                writer.writerows(filas)
+            firma_nueva = _firma()
+        # Si otro proceso escribió entre medias, la caché se pone al día en la próxima carga
+        # leyendo la cola del fichero, que ya incluye estas filas
+        if _cache['firma'] == firma_previa:
+            anterior = _cache['version']
+            _aplicar_filas(filas)
+            _cache['firma'] = firma_nueva
+            _cache['bytes'] = firma_nueva[1]
+            _cache['registros'] += len(filas)
+            _notificar(anterior, _cache['version'], filas)
+            _programar_compactacion()
+
+
+# Función para añadir un nuevo producto; devuelve su ID
+def añadir_producto(vendedor, correo, producto, descripcion, foto, precio):
+    id_producto = _nuevo_id()
+    valores = _sin_vacios([vendedor, correo, producto, descripcion, foto, precio])
+    _añadir_registros([[id_producto, 'alta'] + valores])
+    # La miniatura se genera en segundo plano para no descargar la foto al mostrar el catálogo
+    encolar_miniatura(foto)
+    return id_producto
+
+
+# Función para obtener los valores vigentes de un producto (None si no existe)
+def _valores_producto(id_producto):
+    with _bloqueo:
+        _poner_al_dia()
+        if not _vigente(id_producto):
+            return None
+        for pendientes in (_cache['altas'], _cache['ediciones']):
+            if id_producto in pendientes:
+                return list(pendientes[id_producto])
+        return _cache['base'].loc[id_producto, COLUMNAS_PRODUCTO].tolist()
+
+
+# Función para modificar los datos de un producto
+def editar_producto(id_producto, **cambios):
+    valores = _valores_producto(id_producto)
+    if valores is None:
+        return
+    datos = dict(zip(COLUMNAS_PRODUCTO, valores))
+    datos.update({columna: valor for columna, valor in cambios.items() if columna in COLUMNAS_PRODUCTO})
+    valores = _sin_vacios([datos[columna] for columna in COLUMNAS_PRODUCTO])
+    _añadir_registros([[id_producto, 'edicion'] + valores])
+    if 'Foto' in cambios:
+        encolar_miniatura(cambios['Foto'])
+
+
+# Función para eliminar un producto
+def eliminar_producto(id_producto):
+    with _bloqueo:
+        _poner_al_dia()
+        if not _vigente(id_producto):
+            return
+    _añadir_registros([[id_producto, 'baja'] + [None] * len(COLUMNAS_PRODUCTO)])
+
+
+# Función para lanzar la compactación en segundo plano cuando sobran demasiados registros
+def _programar_compactacion():
+    obsoletos = _cache['registros'] - _num_vigentes()
+    if obsoletos >= COMPACTAR_MINIMO and obsoletos >= COMPACTAR_PROPORCION * _cache['registros']:
+        if not _compactacion_pendiente.is_set():
+            _compactacion_pendiente.set()
+            _compactador.submit(compactar_catalogo)
+
+
+# Función para reescribir el catálogo dejando solo los productos vigentes
+def compactar_catalogo():
+    try:
+        with bloqueo_fichero(RUTA_CATALOGO):
+            firma_previa = _firma()
+            registro = pd.read_csv(RUTA_CATALOGO, encoding='utf-8', dtype={'ID': str})
+            vigentes = _aplicar_registro(registro)
+            compactado = vigentes.reset_index()
+            compactado.insert(1, 'Operación', 'alta')
+            _reescribir(compactado)
+            firma = _firma()
+            stat = os.stat(RUTA_CATALOGO)
+        if USAR_INSTANTANEA:
+            _guardar_instantanea(vigentes, len(vigentes), stat)
+        with _bloqueo:
+            # Si la caché estaba al día su contenido no cambia (ni su versión), solo la firma del fichero
+            if _cache['base'] is not None and _cache['firma'] == firma_previa and _firma() == firma:
+                _cache['base'] = _cache['df'] = vigentes
+                _cache['altas'], _cache['ediciones'], _cache['bajas'] = {}, {}, set()
+                _cache['firma'] = firma
+                _cache['inodo'] = stat.st_ino
+                _cache['bytes'] = stat.st_size
+                _cache['registros'] = len(vigentes)
+    finally:
+        _compactacion_pendiente.clear()
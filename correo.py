@@ -0,0 +1,383 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from importlib import metadata
+
+import mensajes
+from metricas import contar, cronometrar, registrar_tiempo
+
+# Configuración de la bandeja de salida de correos
+RUTA_BD_CORREO = os.getenv('WALLACORE_BD_CORREO', 'correo.db')
+TRANSPORTE_CORREO = os.getenv('WALLACORE_TRANSPORTE_CORREO', 'nylas')  # 'nylas' o 'falso'
+MAX_INTENTOS = int(os.getenv('WALLACORE_CORREO_INTENTOS', '5'))
+ESPERA_BASE = float(os.getenv('WALLACORE_CORREO_ESPERA_BASE', '30'))  # Segundos antes del primer reintento
+ESPERA_MAXIMA = float(os.getenv('WALLACORE_CORREO_ESPERA_MAXIMA', '3600'))
+INTERVALO_SONDEO = float(os.getenv('WALLACORE_CORREO_SONDEO', '5'))
+TIEMPO_RECLAMO = 300  # Un correo 'enviando' durante más tiempo se da por abandonado
+RETENCION_ENVIADOS = float(os.getenv('WALLACORE_CORREO_RETENCION', '86400'))  # Segundos que se guardan los enviados
+
+# Cliente de Nylas compartido por el proceso
+NYLAS_TIMEOUT_CONEXION = float(os.getenv('WALLACORE_NYLAS_TIMEOUT_CONEXION', '3'))
+NYLAS_TIMEOUT_LECTURA = float(os.getenv('WALLACORE_NYLAS_TIMEOUT_LECTURA', '15'))
+NYLAS_CONEXIONES = int(os.getenv('WALLACORE_NYLAS_CONEXIONES', '4'))
+# Versión del SDK de Nylas cuyo HttpClient._execute replica _crear_cliente_http; con otras versiones
+# admitidas por requirements.txt se usa el cliente HTTP original del SDK
+NYLAS_VERSION_PROBADA = '6.18.0'
+
+# Los avisos a un mismo destinatario se agrupan en un único correo de resumen
+VENTANA_AVISOS = float(os.getenv('WALLACORE_VENTANA_AVISOS', '60'))  # Segundos
+VENTANA_RESUMEN_DIARIO = 24 * 3600
+
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS salida (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    destinatario TEXT NOT NULL,
+    asunto TEXT NOT NULL,
+    cuerpo TEXT NOT NULL,
+    estado TEXT NOT NULL DEFAULT 'pendiente',
+    intentos INTEGER NOT NULL DEFAULT 0,
+    siguiente_intento REAL NOT NULL,
+    reclamado REAL,
+    error TEXT,
+    creado REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_salida_estado ON salida (estado, siguiente_intento);
+CREATE TABLE IF NOT EXISTS avisos (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    destinatario TEXT NOT NULL,
+    remitente TEXT NOT NULL,
+    producto TEXT NOT NULL,
+    mensaje TEXT NOT NULL,
+    creado REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_avisos_destinatario ON avisos (destinatario);
+CREATE TABLE IF NOT EXISTS preferencias (
+    usuario TEXT PRIMARY KEY,
+    resumen_diario INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+# Estados: 'pendiente' -> 'enviando' -> 'enviado', o 'fallido' (lista de fallidos) tras MAX_INTENTOS.
+# Los enviados se borran pasado RETENCION_ENVIADOS desde que se reclamaron para enviarlos.
+_conexion = None
+_bloqueo = threading.RLock()
+_aviso = threading.Event()
+_trabajador = None
+_transporte = None
+_cliente_nylas = None
+_bloqueo_nylas = threading.Lock()
+
+# Correos "enviados" por el transporte falso, para pruebas locales
+CORREOS_FALSOS = []
+
+
+# Función para crear el cliente HTTP de Nylas sobre una sesión con conexiones keep-alive.
+# El SDK abre una conexión nueva en cada petición con requests.request. _execute es interno del SDK:
+# esta copia corresponde a NYLAS_VERSION_PROBADA y hay que revisarla al actualizar nylas.
+def _crear_cliente_http(api_uri, api_key):
+    import requests
+    from nylas.handler.http_client import HttpClient, _validate_response
+    from nylas.models.errors import NylasSdkTimeoutError
+    from requests.adapters import HTTPAdapter
+
+    class HttpClientConSesion(HttpClient):
+        def __init__(self):
+            super().__init__(api_uri, api_key, (NYLAS_TIMEOUT_CONEXION, NYLAS_TIMEOUT_LECTURA))
+            self.sesion = requests.Session()
+            adaptador = HTTPAdapter(pool_connections=1, pool_maxsize=NYLAS_CONEXIONES)
+            self.sesion.mount('https://', adaptador)
+            self.sesion.mount('http://', adaptador)
+
+        def _execute(self, method, path, headers=None, query_params=None, request_body=None, data=None,
+                     overrides=None, serialized_json_body=None):
+            request = self._build_request(method, path, headers, query_params, request_body, data, overrides,
+                                          serialized_json_body=serialized_json_body)
+            if serialized_json_body is not None and data is None:
+                data = serialized_json_body
+            elif request_body is not None and data is None:
+                data = json.dumps(request_body, ensure_ascii=False).encode('utf-8')
+            timeout = (overrides or {}).get('timeout') or self.timeout
+            try:
+                response = self.sesion.request(request['method'], request['url'], headers=request['headers'],
+                                               data=data, timeout=timeout)
+            except requests.exceptions.Timeout as exc:
+                raise NylasSdkTimeoutError(url=request['url'], timeout=timeout) from exc
+            return _validate_response(response)
+
+    return HttpClientConSesion()
+
+
+def _version_nylas():
+    try:
+        return metadata.version('nylas')
+    except metadata.PackageNotFoundError:
+        return None
+
+
+# Función para obtener el cliente de Nylas, creado una sola vez por proceso
+def obtener_cliente_nylas():
+    global _cliente_nylas
+    if _cliente_nylas is None:
+        with _bloqueo_nylas:
+            if _cliente_nylas is None:
+                import streamlit as st
+                from nylas import Client
+
+                cliente = Client(api_key=st.secrets["nylas"]["access_token"])
+                # Con otra versión del SDK se usa su cliente HTTP original, sin reutilizar conexiones
+                if _version_nylas() == NYLAS_VERSION_PROBADA:
+                    cliente.http_client = _crear_cliente_http(cliente.api_uri, cliente.api_key)
+                cliente.remitente = st.secrets["email"]["remitente"]  # Cuenta (grant) desde la que se envía
+                _cliente_nylas = cliente
+    return _cliente_nylas
+
+
+# Transporte que envía el correo a través de la API de Nylas, con una sola petición.
+# En las métricas, correo.nylas mide solo los envíos correctos y correo.nylas_error los fallidos.
+def transporte_nylas(destinatario, asunto, cuerpo):
+    cliente = obtener_cliente_nylas()
+    inicio = time.perf_counter()
+    try:
+        cliente.messages.send(cliente.remitente, request_body={
+            "to": [{"email": destinatario}],
+            "subject": asunto,
+            "body": cuerpo,
+        })
+    except Exception:
+        registrar_tiempo('correo.nylas_error', time.perf_counter() - inicio)
+        contar('correo.errores_nylas')
+        raise
+    registrar_tiempo('correo.nylas', time.perf_counter() - inicio)
+
+
+# Transporte local que solo guarda el correo en memoria
+def transporte_falso(destinatario, asunto, cuerpo):
+    CORREOS_FALSOS.append((destinatario, asunto, cuerpo))
+
+
+# Función para elegir el transporte; recibe una función (destinatario, asunto, cuerpo)
+# que lanza una excepción si el envío falla
+def configurar_transporte(transporte):
+    global _transporte
+    _transporte = transporte
+
+
+def obtener_transporte():
+    if _transporte is None:
+        configurar_transporte(transporte_falso if TRANSPORTE_CORREO == 'falso' else transporte_nylas)
+    return _transporte
+
+
+# Función para abrir la base de datos de la bandeja de salida
+def conectar():
+    global _conexion
+    with _bloqueo:
+        if _conexion is None:
+            conexion = sqlite3.connect(RUTA_BD_CORREO, timeout=10, check_same_thread=False)
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.executescript(ESQUEMA)
+            _conexion = conexion
+        return _conexion
+
+
+# Función para dejar un correo en la bandeja de salida; el envío lo hace el trabajador
+def encolar_correo(destinatario, asunto, cuerpo):
+    conexion = conectar()
+    ahora = time.time()
+    with _bloqueo, conexion:
+        conexion.execute(
+            "INSERT INTO salida (destinatario, asunto, cuerpo, siguiente_intento, creado) VALUES (?, ?, ?, ?, ?)",
+            (destinatario, asunto, cuerpo, ahora, ahora))
+    iniciar_trabajador()
+    _aviso.set()
+
+
+# Función para avisar de un mensaje nuevo; se enviará agrupado con los demás avisos del destinatario
+def encolar_aviso(destinatario, remitente, producto, mensaje):
+    conexion = conectar()
+    with _bloqueo, conexion:
+        conexion.execute(
+            "INSERT INTO avisos (destinatario, remitente, producto, mensaje, creado) VALUES (?, ?, ?, ?, ?)",
+            (destinatario, remitente, producto, mensaje, time.time()))
+    iniciar_trabajador()
+    if VENTANA_AVISOS <= 0:
+        _aviso.set()
+
+
+# Oyente de mensajes.enviar_mensaje: avisa al destinatario de cada mensaje nuevo
+def _avisar_mensaje(remitente, destinatario, producto, mensaje):
+    encolar_aviso(destinatario, remitente, producto, mensaje)
+
+
+# Función para avisar por correo de los mensajes enviados con mensajes.enviar_mensaje
+def activar_avisos():
+    mensajes.suscribir(_avisar_mensaje)
+
+
+# Función para activar o desactivar el resumen diario de un usuario
+def configurar_resumen_diario(usuario, activo):
+    conexion = conectar()
+    with _bloqueo, conexion:
+        conexion.execute(
+            "INSERT INTO preferencias (usuario, resumen_diario) VALUES (?, ?) "
+            "ON CONFLICT (usuario) DO UPDATE SET resumen_diario = excluded.resumen_diario",
+            (usuario, int(activo)))
+
+
+def obtener_resumen_diario(usuario):
+    conexion = conectar()
+    with _bloqueo:
+        fila = conexion.execute("SELECT resumen_diario FROM preferencias WHERE usuario = ?", (usuario,)).fetchone()
+    return bool(fila and fila[0])
+
+
+# Función para redactar el correo que resume los avisos de un destinatario
+def redactar_resumen(avisos):
+    if len(avisos) == 1:
+        remitente, producto, mensaje = avisos[0]
+        asunto = f"Nuevo mensaje sobre {producto} en Wallacore"
+        cuerpo = f"Hola,\n\nHas recibido un nuevo mensaje de {remitente} sobre el producto {producto}:\n\n{mensaje}\n\nInicia sesión en Wallacore para responder."
+        return asunto, cuerpo
+    asunto = f"Tienes {len(avisos)} mensajes nuevos en Wallacore"
+    lineas = [f"- De {remitente} sobre {producto}:\n  {mensaje}" for remitente, producto, mensaje in avisos]
+    cuerpo = "Hola,\n\nHas recibido nuevos mensajes:\n\n" + "\n\n".join(lineas) + "\n\nInicia sesión en Wallacore para responder."
+    return asunto, cuerpo
+
+
+# Función para convertir en correos los avisos cuya ventana de agrupación ha terminado
+def agrupar_avisos():
+    conexion = conectar()
+    ahora = time.time()
+    agrupados = 0
+    with _bloqueo:
+        # BEGIN IMMEDIATE para que dos procesos no agrupen los mismos avisos
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            destinatarios = conexion.execute("""
+                SELECT a.destinatario FROM avisos a
+                LEFT JOIN preferencias p ON p.usuario = a.destinatario
+                GROUP BY a.destinatario
+                HAVING MIN(a.creado) <= ? - CASE WHEN MAX(COALESCE(p.resumen_diario, 0)) THEN ? ELSE ? END
+            """, (ahora, VENTANA_RESUMEN_DIARIO, VENTANA_AVISOS)).fetchall()
+            for (destinatario,) in destinatarios:
+                avisos = conexion.execute(
+                    "SELECT id, remitente, producto, mensaje FROM avisos "
+                    "WHERE destinatario = ? ORDER BY id",
+                    (destinatario,)).fetchall()
+                asunto, cuerpo = redactar_resumen([fila[1:] for fila in avisos])
+                conexion.execute(
+                    "INSERT INTO salida (destinatario, asunto, cuerpo, siguiente_intento, creado) VALUES (?, ?, ?, ?, ?)",
+                    (destinatario, asunto, cuerpo, ahora, ahora))
+                conexion.executemany("DELETE FROM avisos WHERE id = ?", [(fila[0],) for fila in avisos])
+                agrupados += 1
+            conexion.commit()
+        except Exception:
+            conexion.rollback()
+            raise
+    return agrupados
+
+
+# Función para reclamar los correos pendientes cuyo intento ya toca
+def _reclamar_pendientes(limite=20):
+    conexion = conectar()
+    ahora = time.time()
+    with _bloqueo, conexion:
+        # Recuperar correos que otro proceso dejó a medio enviar
+        conexion.execute(
+            "UPDATE salida SET estado = 'pendiente' WHERE estado = 'enviando' AND reclamado < ?",
+            (ahora - TIEMPO_RECLAMO,))
+        filas = conexion.execute(
+            "SELECT id, destinatario, asunto, cuerpo, intentos FROM salida "
+            "WHERE estado = 'pendiente' AND siguiente_intento <= ? ORDER BY id LIMIT ?",
+            (ahora, limite)).fetchall()
+        reclamadas = []
+        for fila in filas:
+            cursor = conexion.execute(
+                "UPDATE salida SET estado = 'enviando', reclamado = ? WHERE id = ? AND estado = 'pendiente'",
+                (ahora, fila[0]))
+            if cursor.rowcount:
+                reclamadas.append(fila)
+    return reclamadas
+
+
+# Función para enviar una tanda de correos pendientes; devuelve cuántos se enviaron
+@cronometrar('correo.procesar')
+def procesar_pendientes():
+    conexion = conectar()
+    enviados = 0
+    for id_correo, destinatario, asunto, cuerpo, intentos in _reclamar_pendientes():
+        try:
+            obtener_transporte()(destinatario, asunto, cuerpo)
+        except Exception as e:
+            contar('correo.reintentos')
+            intentos += 1
+            # Espera exponencial: ESPERA_BASE, 2·ESPERA_BASE, 4·ESPERA_BASE... hasta ESPERA_MAXIMA
+            espera = min(ESPERA_BASE * 2 ** (intentos - 1), ESPERA_MAXIMA)
+            estado = 'fallido' if intentos >= MAX_INTENTOS else 'pendiente'
+            with _bloqueo, conexion:
+                conexion.execute(
+                    "UPDATE salida SET estado = ?, intentos = ?, siguiente_intento = ?, error = ? WHERE id = ?",
+                    (estado, intentos, time.time() + espera, str(e), id_correo))
+        else:
+            enviados += 1
+            contar('correo.enviados')
+            with _bloqueo, conexion:
+                conexion.execute(
+                    "UPDATE salida SET estado = 'enviado', intentos = ?, error = NULL WHERE id = ?",
+                    (intentos + 1, id_correo))
+    return enviados
+
+
+# Función para borrar los correos enviados hace más de RETENCION_ENVIADOS; devuelve cuántos se borraron
+def purgar_enviados():
+    conexion = conectar()
+    with _bloqueo, conexion:
+        cursor = conexion.execute(
+            "DELETE FROM salida WHERE estado = 'enviado' AND reclamado <= ?",
+            (time.time() - RETENCION_ENVIADOS,))
+    if cursor.rowcount:
+        contar('correo.purgados', cursor.rowcount)
+    return cursor.rowcount
+
+
+def _bucle_trabajador():
+    while True:
+        try:
+            agrupar_avisos()
+            procesar_pendientes()
+            purgar_enviados()
+        except Exception:
+            # Un error de la base de datos no debe matar al trabajador, pero queda contado en las métricas
+            contar('correo.errores_trabajador')
+        _aviso.wait(INTERVALO_SONDEO)
+        _aviso.clear()
+
+
+# Función para arrancar (una sola vez por proceso) el hilo que vacía la bandeja de salida
+def iniciar_trabajador():
+    global _trabajador
+    with _bloqueo:
+        if _trabajador is None or not _trabajador.is_alive():
+            _trabajador = threading.Thread(target=_bucle_trabajador, name='bandeja-salida', daemon=True)
+            _trabajador.start()
+
+
+# Función para consultar la lista de correos que agotaron sus reintentos
+def listar_fallidos():
+    conexion = conectar()
+    with _bloqueo:
+        return conexion.execute(
+            "SELECT id, destinatario, asunto, intentos, error, creado FROM salida "
+            "WHERE estado = 'fallido' ORDER BY id").fetchall()
+
+
+# Función para volver a poner en cola los correos fallidos
+def reintentar_fallidos():
+    conexion = conectar()
+    with _bloqueo, conexion:
+        conexion.execute(
+            "UPDATE salida SET estado = 'pendiente', intentos = 0, siguiente_intento = ? WHERE estado = 'fallido'",
+            (time.time(),))
+    _aviso.set()
@@ -0,0 +1,645 @@
+import csv
+import io
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+from bloqueos import bloqueo_fichero
+from metricas import contar, cronometrar
+
+# Motor de almacenamiento de los mensajes: 'sqlite' (por defecto) o 'csv'
+MOTOR_MENSAJES = os.getenv('WALLACORE_MOTOR_MENSAJES', 'sqlite')
+RUTA_CSV_MENSAJES = os.getenv('WALLACORE_MENSAJES_CSV', 'mensajes.csv')
+RUTA_BD_MENSAJES = os.getenv('WALLACORE_BD_MENSAJES', 'mensajes.db')
+RUTA_NO_LEIDOS_CSV = os.getenv('WALLACORE_NO_LEIDOS_CSV', 'mensajes_no_leidos.json')
+RUTA_ELIMINADOS_CSV = os.getenv('WALLACORE_ELIMINADOS_CSV', 'mensajes_eliminados.json')
+FORMATO_FECHA = "%Y-%m-%d %H:%M"
+CABECERA_CSV = ['fecha', 'remitente', 'destinatario', 'producto', 'mensaje']
+
+# Conexión SQLite compartida por todas las sesiones del proceso. Con varios procesos, las
+# operaciones que leen y después escriben abren la transacción con BEGIN IMMEDIATE.
+_conexion = None
+_bloqueo = threading.RLock()
+# Funciones que se llaman tras enviar cada mensaje con enviar_mensaje, p. ej. el aviso por correo
+_oyentes = []
+
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS mensajes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    fecha TEXT NOT NULL,
+    remitente TEXT NOT NULL,
+    destinatario TEXT NOT NULL,
+    producto TEXT NOT NULL,
+    mensaje TEXT NOT NULL,
+    leido INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_mensajes_destinatario ON mensajes (destinatario, fecha);
+CREATE INDEX IF NOT EXISTS idx_mensajes_remitente ON mensajes (remitente, fecha);
+CREATE INDEX IF NOT EXISTS idx_mensajes_fecha ON mensajes (fecha);
+CREATE INDEX IF NOT EXISTS idx_mensajes_conversacion ON mensajes (remitente, destinatario, producto, id);
+CREATE TABLE IF NOT EXISTS meta (
+    clave TEXT PRIMARY KEY,
+    valor TEXT
+);
+CREATE TABLE IF NOT EXISTS no_leidos (
+    usuario TEXT PRIMARY KEY,
+    cantidad INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS recibidos_por_producto (
+    usuario TEXT NOT NULL,
+    producto TEXT NOT NULL,
+    cantidad INTEGER NOT NULL,
+    PRIMARY KEY (usuario, producto)
+);
+CREATE TABLE IF NOT EXISTS hilos (
+    usuario TEXT NOT NULL,
+    producto TEXT NOT NULL,
+    interlocutor TEXT NOT NULL,
+    ultimo_id INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    no_leidos INTEGER NOT NULL,
+    PRIMARY KEY (usuario, producto, interlocutor)
+);
+CREATE INDEX IF NOT EXISTS idx_hilos_usuario ON hilos (usuario, ultimo_id);
+"""
+
+
+# Función para abrir (una sola vez por proceso) la base de datos de mensajes
+def conectar():
+    global _conexion
+    with _bloqueo:
+        if _conexion is None:
+            conexion = sqlite3.connect(RUTA_BD_MENSAJES, timeout=10, check_same_thread=False)
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute("PRAGMA synchronous=NORMAL")
+            _crear_esquema(conexion)
+            migrar_desde_csv(conexion)
+            _conexion = conexion
+        return _conexion
+
+
+# Función para crear las tablas, actualizando las bases de datos de versiones anteriores
+def _crear_esquema(conexion):
+    with conexion:
+        conexion.execute("BEGIN IMMEDIATE")  # Varios procesos pueden arrancar a la vez
+        columnas = [row[1] for row in conexion.execute("PRAGMA table_info(mensajes)")]
+        if columnas and 'leido' not in columnas:
+            # Los mensajes guardados antes de existir el estado de lectura se consideran leídos
+            conexion.execute("ALTER TABLE mensajes ADD COLUMN leido INTEGER NOT NULL DEFAULT 0")
+            conexion.execute("UPDATE mensajes SET leido = 1")
+    conexion.executescript(ESQUEMA)
+    with conexion:
+        conexion.execute("BEGIN IMMEDIATE")
+        if not conexion.execute("SELECT 1 FROM meta WHERE clave = 'contadores_no_leidos'").fetchone():
+            conexion.execute("DELETE FROM no_leidos")
+            conexion.execute(
+                "INSERT INTO no_leidos (usuario, cantidad) "
+                "SELECT destinatario, COUNT(*) FROM mensajes WHERE leido = 0 GROUP BY destinatario")
+            conexion.execute("INSERT INTO meta (clave, valor) VALUES ('contadores_no_leidos', '1')")
+        if not conexion.execute("SELECT 1 FROM meta WHERE clave = 'contadores_producto'").fetchone():
+            _recontar_por_producto(conexion)
+            conexion.execute("INSERT INTO meta (clave, valor) VALUES ('contadores_producto', '1')")
+        if not conexion.execute("SELECT 1 FROM meta WHERE clave = 'hilos'").fetchone():
+            _recontar_hilos(conexion)
+            conexion.execute("INSERT INTO meta (clave, valor) VALUES ('hilos', '1')")
+
+
+# Función para recalcular cuántos mensajes ha recibido cada usuario sobre cada producto
+def _recontar_por_producto(conexion):
+    conexion.execute("DELETE FROM recibidos_por_producto")
+    conexion.execute(
+        "INSERT INTO recibidos_por_producto (usuario, producto, cantidad) "
+        "SELECT destinatario, producto, COUNT(*) FROM mensajes GROUP BY destinatario, producto")
+
+
+# Función para reconstruir el índice de conversaciones. Un hilo agrupa los mensajes
+# entre dos usuarios sobre un producto y cada participante tiene su propia fila.
+def _recontar_hilos(conexion):
+    conexion.execute("DELETE FROM hilos")
+    conexion.execute("""
+        INSERT INTO hilos (usuario, producto, interlocutor, ultimo_id, total, no_leidos)
+        SELECT usuario, producto, interlocutor, MAX(id), COUNT(*), SUM(no_leido) FROM (
+            SELECT destinatario AS usuario, producto, remitente AS interlocutor, id, leido = 0 AS no_leido
+            FROM mensajes
+            UNION ALL
+            SELECT remitente, producto, destinatario, id, 0 FROM mensajes WHERE remitente != destinatario
+        )
+        GROUP BY usuario, producto, interlocutor
+    """)
+
+
+# Función para añadir un mensaje al hilo de uno de sus participantes
+def _añadir_a_hilo(conexion, usuario, producto, interlocutor, id_mensaje, no_leido):
+    conexion.execute(
+        "INSERT INTO hilos (usuario, producto, interlocutor, ultimo_id, total, no_leidos) VALUES (?, ?, ?, ?, 1, ?) "
+        "ON CONFLICT (usuario, producto, interlocutor) DO UPDATE SET "
+        "ultimo_id = excluded.ultimo_id, total = total + 1, no_leidos = no_leidos + excluded.no_leidos",
+        (usuario, producto, interlocutor, id_mensaje, no_leido))
+
+
+# Función para importar una única vez los mensajes del antiguo mensajes.csv
+def migrar_desde_csv(conexion, ruta_csv=RUTA_CSV_MENSAJES):
+    with conexion:
+        conexion.execute("BEGIN IMMEDIATE")
+        if conexion.execute("SELECT 1 FROM meta WHERE clave = 'migrado_csv'").fetchone():
+            return 0
+        filas = []
+        if os.path.exists(ruta_csv):
+            eliminados = set(_leer_eliminados_csv())
+            with open(ruta_csv, 'r', encoding='utf-8') as file:
+                reader = csv.reader(file)
+                next(reader, None)  # Saltar la fila de encabezados
+                filas = [row[:5] for id_mensaje, row in enumerate(reader)
+                         if len(row) >= 5 and id_mensaje not in eliminados]
+        # Los mensajes importados se consideran leídos
+        conexion.executemany(
+            "INSERT INTO mensajes (fecha, remitente, destinatario, producto, mensaje, leido) VALUES (?, ?, ?, ?, ?, 1)",
+            filas)
+        if filas:
+            _recontar_por_producto(conexion)
+            _recontar_hilos(conexion)
+        conexion.execute("INSERT INTO meta (clave, valor) VALUES ('migrado_csv', ?)",
+                         (datetime.now().strftime(FORMATO_FECHA),))
+    return len(filas)
+
+
+# Función para guardar un mensaje
+@cronometrar('mensajes.guardar')
+def guardar_mensaje(remitente, destinatario, producto, mensaje):
+    fila = [datetime.now().strftime(FORMATO_FECHA), remitente, destinatario, producto, mensaje]
+    if MOTOR_MENSAJES == 'csv':
+        _guardar_csv(fila)
+        return
+    conexion = conectar()
+    with _bloqueo, conexion:
+        id_mensaje = conexion.execute(
+            "INSERT INTO mensajes (fecha, remitente, destinatario, producto, mensaje) VALUES (?, ?, ?, ?, ?)",
+            fila).lastrowid
+        conexion.execute(
+            "INSERT INTO no_leidos (usuario, cantidad) VALUES (?, 1) "
+            "ON CONFLICT (usuario) DO UPDATE SET cantidad = cantidad + 1",
+            (destinatario,))
+        conexion.execute(
+            "INSERT INTO recibidos_por_producto (usuario, producto, cantidad) VALUES (?, ?, 1) "
+            "ON CONFLICT (usuario, producto) DO UPDATE SET cantidad = cantidad + 1",
+            (destinatario, producto))
+        _añadir_a_hilo(conexion, destinatario, producto, remitente, id_mensaje, 1)
+        if remitente != destinatario:
+            _añadir_a_hilo(conexion, remitente, producto, destinatario, id_mensaje, 0)
+
+
+# Función para registrar una función (remitente, destinatario, producto, mensaje) que se llama tras
+# enviar cada mensaje; registrarla más de una vez no tiene efecto
+def suscribir(oyente):
+    with _bloqueo:
+        if oyente not in _oyentes:
+            _oyentes.append(oyente)
+
+
+# Función para enviar un mensaje: lo guarda y avisa a los oyentes suscritos
+@cronometrar('mensajes.enviar')
+def enviar_mensaje(remitente, destinatario, producto, mensaje):
+    guardar_mensaje(remitente, destinatario, producto, mensaje)
+    for oyente in list(_oyentes):
+        oyente(remitente, destinatario, producto, mensaje)
+
+
+# Función para cargar los mensajes de un usuario, del más reciente al más antiguo.
+# Cada mensaje es [fecha, remitente, destinatario, producto, mensaje, id, leido].
+@cronometrar('mensajes.cargar')
+def cargar_mensajes(usuario, limite=None, desplazamiento=0):
+    if MOTOR_MENSAJES == 'csv':
+        mensajes = _cargar_csv(usuario)
+        return mensajes[desplazamiento:desplazamiento + limite if limite is not None else None]
+    conexion = conectar()
+    with _bloqueo:
+        cursor = conexion.execute("""
+            SELECT fecha, remitente, destinatario, producto, mensaje, id, leido FROM (
+                SELECT * FROM mensajes WHERE destinatario = :usuario
+                UNION ALL
+                SELECT * FROM mensajes WHERE remitente = :usuario AND destinatario != :usuario
+            )
+            ORDER BY fecha DESC, id DESC
+            LIMIT :limite OFFSET :desplazamiento
+        """, {'usuario': usuario, 'limite': -1 if limite is None else limite, 'desplazamiento': desplazamiento})
+        mensajes = [list(row[:6]) + [bool(row[6])] for row in cursor]
+    contar('mensajes.filas_leidas', len(mensajes))
+    return mensajes
+
+
+# Función para eliminar un mensaje por su identificador
+def eliminar_mensaje(id_mensaje):
+    if MOTOR_MENSAJES == 'csv':
+        _eliminar_csv(id_mensaje)
+        return
+    conexion = conectar()
+    with _bloqueo, conexion:
+        conexion.execute("BEGIN IMMEDIATE")
+        fila = conexion.execute(
+            "SELECT destinatario, leido, producto, remitente FROM mensajes WHERE id = ?", (id_mensaje,)).fetchone()
+        if not fila:
+            return
+        destinatario, leido, producto, remitente = fila
+        conexion.execute("DELETE FROM mensajes WHERE id = ?", (id_mensaje,))
+        if not leido:
+            conexion.execute("UPDATE no_leidos SET cantidad = cantidad - 1 WHERE usuario = ?", (destinatario,))
+        conexion.execute(
+            "UPDATE recibidos_por_producto SET cantidad = cantidad - 1 WHERE usuario = ? AND producto = ?",
+            (destinatario, producto))
+        # Quitar el mensaje del hilo de cada participante y buscar el nuevo último mensaje
+        for usuario, interlocutor in {(destinatario, remitente), (remitente, destinatario)}:
+            conexion.execute(
+                "UPDATE hilos SET total = total - 1, no_leidos = no_leidos - ? "
+                "WHERE usuario = ? AND producto = ? AND interlocutor = ?",
+                (int(usuario == destinatario and not leido), usuario, producto, interlocutor))
+        conexion.execute("DELETE FROM hilos WHERE ultimo_id = ? AND total <= 0", (id_mensaje,))
+        conexion.execute("""
+            UPDATE hilos SET ultimo_id = (
+                SELECT MAX(id) FROM mensajes
+                WHERE producto = hilos.producto AND (
+                    (remitente = hilos.usuario AND destinatario = hilos.interlocutor) OR
+                    (remitente = hilos.interlocutor AND destinatario = hilos.usuario))
+            )
+            WHERE ultimo_id = ?
+        """, (id_mensaje,))
+
+
+# Función para marcar como leído un mensaje recibido por el usuario
+def marcar_leido(id_mensaje, usuario):
+    if MOTOR_MENSAJES == 'csv':
+        _marcar_leido_csv(id_mensaje, usuario)
+        return
+    conexion = conectar()
+    with _bloqueo, conexion:
+        conexion.execute("BEGIN IMMEDIATE")
+        fila = conexion.execute(
+            "SELECT remitente, producto FROM mensajes WHERE id = ? AND destinatario = ? AND leido = 0",
+            (id_mensaje, usuario)).fetchone()
+        if fila:
+            conexion.execute("UPDATE mensajes SET leido = 1 WHERE id = ?", (id_mensaje,))
+            conexion.execute("UPDATE no_leidos SET cantidad = cantidad - 1 WHERE usuario = ?", (usuario,))
+            conexion.execute(
+                "UPDATE hilos SET no_leidos = no_leidos - 1 WHERE usuario = ? AND producto = ? AND interlocutor = ?",
+                (usuario, fila[1], fila[0]))
+
+
+# Función para marcar como leídos todos los mensajes recibidos en un hilo
+def marcar_hilo_leido(usuario, producto, interlocutor):
+    if MOTOR_MENSAJES == 'csv':
+        _marcar_hilo_leido_csv(usuario, producto, interlocutor)
+        return
+    conexion = conectar()
+    with _bloqueo, conexion:
+        cursor = conexion.execute(
+            "UPDATE mensajes SET leido = 1 WHERE remitente = ? AND destinatario = ? AND producto = ? AND leido = 0",
+            (interlocutor, usuario, producto))
+        if cursor.rowcount:
+            conexion.execute("UPDATE no_leidos SET cantidad = cantidad - ? WHERE usuario = ?",
+                             (cursor.rowcount, usuario))
+            conexion.execute(
+                "UPDATE hilos SET no_leidos = 0 WHERE usuario = ? AND producto = ? AND interlocutor = ?",
+                (usuario, producto, interlocutor))
+
+
+# Función para cargar las conversaciones de un usuario, de la más reciente a la más antigua.
+# Cada hilo es [producto, interlocutor, fecha, remitente, mensaje, total, no_leidos],
+# con la fecha, el remitente y el texto de su último mensaje.
+@cronometrar('mensajes.cargar_hilos')
+def cargar_hilos(usuario, limite=None, desplazamiento=0):
+    if MOTOR_MENSAJES == 'csv':
+        return _cargar_hilos_csv(usuario, limite, desplazamiento)
+    conexion = conectar()
+    with _bloqueo:
+        cursor = conexion.execute("""
+            SELECT h.producto, h.interlocutor, m.fecha, m.remitente, m.mensaje, h.total, h.no_leidos
+            FROM hilos h JOIN mensajes m ON m.id = h.ultimo_id
+            WHERE h.usuario = ?
+            ORDER BY h.ultimo_id DESC
+            LIMIT ? OFFSET ?
+        """, (usuario, -1 if limite is None else limite, desplazamiento))
+        return [list(row) for row in cursor]
+
+
+# Función para contar las conversaciones de un usuario
+def contar_hilos(usuario):
+    if MOTOR_MENSAJES == 'csv':
+        with _bloqueo:
+            _actualizar_lector_csv()
+            return len(_lector_csv['hilos'].get(usuario, ()))
+    conexion = conectar()
+    with _bloqueo:
+        return conexion.execute("SELECT COUNT(*) FROM hilos WHERE usuario = ?", (usuario,)).fetchone()[0]
+
+
+# Función para cargar los mensajes de un hilo, del más reciente al más antiguo,
+# con el mismo formato que cargar_mensajes
+@cronometrar('mensajes.cargar_hilo')
+def cargar_hilo(usuario, producto, interlocutor, limite=None, desplazamiento=0):
+    if MOTOR_MENSAJES == 'csv':
+        return _cargar_hilo_csv(usuario, producto, interlocutor, limite, desplazamiento)
+    conexion = conectar()
+    with _bloqueo:
+        cursor = conexion.execute("""
+            SELECT fecha, remitente, destinatario, producto, mensaje, id, leido FROM (
+                SELECT * FROM mensajes
+                WHERE remitente = :usuario AND destinatario = :interlocutor AND producto = :producto
+                UNION ALL
+                SELECT * FROM mensajes
+                WHERE remitente = :interlocutor AND destinatario = :usuario AND producto = :producto
+                    AND remitente != destinatario
+            )
+            ORDER BY fecha DESC, id DESC
+            LIMIT :limite OFFSET :desplazamiento
+        """, {'usuario': usuario, 'interlocutor': interlocutor, 'producto': producto,
+              'limite': -1 if limite is None else limite, 'desplazamiento': desplazamiento})
+        return [list(row[:6]) + [bool(row[6])] for row in cursor]
+
+
+# Función para contar mensajes no leídos, consultando solo el contador del usuario
+def contar_mensajes_no_leidos(usuario):
+    if MOTOR_MENSAJES == 'csv':
+        with _bloqueo:
+            return len(_leer_no_leidos_csv().get(usuario, []))
+    conexion = conectar()
+    with _bloqueo:
+        fila = conexion.execute("SELECT cantidad FROM no_leidos WHERE usuario = ?", (usuario,)).fetchone()
+    return fila[0] if fila else 0
+
+
+# Función para contar los mensajes recibidos por el usuario sobre cada uno de sus productos
+def contar_mensajes_por_producto(usuario):
+    if MOTOR_MENSAJES == 'csv':
+        recibidos = {}
+        for mensaje in _cargar_csv(usuario):
+            if mensaje[2] == usuario:
+                recibidos[mensaje[3]] = recibidos.get(mensaje[3], 0) + 1
+        return recibidos
+    conexion = conectar()
+    with _bloqueo:
+        cursor = conexion.execute(
+            "SELECT producto, cantidad FROM recibidos_por_producto WHERE usuario = ? AND cantidad > 0", (usuario,))
+        return dict(cursor.fetchall())
+
+
+# Motor CSV: el identificador de un mensaje es su número de fila en el fichero. El fichero solo
+# crece: eliminar un mensaje añade su identificador a RUTA_ELIMINADOS_CSV en lugar de borrar la fila,
+# así los identificadores que otro proceso ya ha mostrado nunca pasan a ser de otro mensaje.
+# Los mensajes pendientes de leer se guardan aparte, como {usuario: [ids]}.
+#
+# Las filas ya leídas se guardan en memoria para leer en cada consulta solo lo añadido después:
+#   inodo, bytes: fichero y posición hasta la que se ha leído
+#   huella: últimos bytes leídos, para detectar que el fichero se ha reescrito
+#   filas: [(fecha, fila)] por identificador, con la fecha ya convertida (None si la fila está mal formada)
+#   por_usuario: {usuario: [ids]} de los mensajes que ha enviado o recibido, sin los eliminados
+#   hilos: {usuario: {(producto, interlocutor): [ids]}}, sin los eliminados
+#   eliminados, firma_eliminados: ids eliminados ya aplicados y firma del fichero del que se leyeron
+TAMAÑO_HUELLA = 64
+_lector_csv = {'eliminados': set(), 'firma_eliminados': None}
+
+
+# Función para olvidar las filas leídas; los eliminados se conservan, no dependen del contenido del fichero
+def _reiniciar_lector_csv():
+    _lector_csv.update({'inodo': None, 'bytes': 0, 'huella': b'', 'filas': [], 'por_usuario': {}, 'hilos': {}})
+
+
+_reiniciar_lector_csv()
+
+
+# Función para poner al día el lector con las filas añadidas y los mensajes eliminados
+@cronometrar('mensajes.leer_csv')
+def _actualizar_lector_csv():
+    _leer_filas_csv()
+    _aplicar_eliminados_csv()
+
+
+# Función para encontrar dónde acaba la última fila completa de un trozo de CSV. Un salto de línea
+# dentro de un mensaje va entre comillas, así que solo cierra una fila si antes hay un número par de
+# comillas (csv.writer las escribe siempre por pares, también las escapadas como "").
+def _fin_ultima_fila(datos):
+    fin = len(datos)
+    while True:
+        fin = datos.rfind(b'\n', 0, fin)
+        if fin < 0 or datos.count(b'"', 0, fin) % 2 == 0:
+            return fin + 1
+
+
+# Función para leer las filas añadidas a mensajes.csv desde la última lectura.
+# Si el fichero se ha truncado o reescrito (otro inodo, más corto o con otra huella) se relee entero.
+def _leer_filas_csv():
+    lector = _lector_csv
+    try:
+        stat = os.stat(RUTA_CSV_MENSAJES)
+    except FileNotFoundError:
+        _reiniciar_lector_csv()
+        return
+    with open(RUTA_CSV_MENSAJES, 'rb') as file:
+        if lector['inodo'] == stat.st_ino and lector['bytes'] <= stat.st_size:
+            file.seek(lector['bytes'] - len(lector['huella']))
+            if file.read(len(lector['huella'])) != lector['huella']:
+                _reiniciar_lector_csv()
+        else:
+            _reiniciar_lector_csv()
+        if lector['bytes'] == stat.st_size:
+            return
+        file.seek(lector['bytes'])
+        datos = file.read(stat.st_size - lector['bytes'])
+    # Solo se procesan filas completas; el resto se leerá cuando acabe de escribirse
+    datos = datos[:_fin_ultima_fila(datos)]
+    if not datos:
+        return
+    reader = csv.reader(io.StringIO(datos.decode('utf-8'), newline=''))
+    if lector['bytes'] == 0:
+        next(reader, None)  # Saltar la fila de encabezados
+    leidas = len(lector['filas'])
+    fechas = {}  # Las fechas van por minutos y se repiten mucho: cada una se convierte una sola vez
+    for row in reader:
+        id_mensaje = len(lector['filas'])
+        if len(row) < 5:
+            lector['filas'].append(None)
+            continue
+        if row[0] not in fechas:
+            fechas[row[0]] = datetime.strptime(row[0], FORMATO_FECHA)
+        lector['filas'].append((fechas[row[0]], row[:5]))
+        if id_mensaje in lector['eliminados']:
+            continue  # Añadido y eliminado por otro proceso después de la última lectura
+        remitente, destinatario, producto = row[1], row[2], row[3]
+        lector['por_usuario'].setdefault(remitente, []).append(id_mensaje)
+        lector['hilos'].setdefault(remitente, {}).setdefault((producto, destinatario), []).append(id_mensaje)
+        if destinatario != remitente:
+            lector['por_usuario'].setdefault(destinatario, []).append(id_mensaje)
+            lector['hilos'].setdefault(destinatario, {}).setdefault((producto, remitente), []).append(id_mensaje)
+    lector['inodo'] = stat.st_ino
+    contar('mensajes.filas_leidas', len(lector['filas']) - leidas)
+    lector['bytes'] += len(datos)
+    lector['huella'] = (lector['huella'] + datos)[-TAMAÑO_HUELLA:]
+
+
+def _quitar_de_lector(id_mensaje, usuario, clave):
+    ids = _lector_csv['por_usuario'].get(usuario)
+    if ids and id_mensaje in ids:
+        ids.remove(id_mensaje)
+    hilos = _lector_csv['hilos'].get(usuario, {})
+    if id_mensaje in hilos.get(clave, ()):
+        hilos[clave].remove(id_mensaje)
+        if not hilos[clave]:
+            del hilos[clave]
+
+
+# Función para quitar del lector los mensajes eliminados desde la última consulta, por este u otro proceso
+def _aplicar_eliminados_csv():
+    lector = _lector_csv
+    try:
+        stat = os.stat(RUTA_ELIMINADOS_CSV)
+        firma = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        firma = None
+    if firma == lector['firma_eliminados']:
+        return
+    eliminados = set(_leer_eliminados_csv())
+    if not lector['eliminados'] <= eliminados:
+        # El fichero de eliminados se ha borrado o rehecho: se vuelven a leer todas las filas
+        lector['eliminados'] = eliminados
+        lector['firma_eliminados'] = firma
+        _reiniciar_lector_csv()
+        _leer_filas_csv()
+        return
+    for id_mensaje in eliminados - lector['eliminados']:
+        if id_mensaje < len(lector['filas']) and lector['filas'][id_mensaje]:
+            _, remitente, destinatario, producto, _ = lector['filas'][id_mensaje][1]
+            _quitar_de_lector(id_mensaje, remitente, (producto, destinatario))
+            _quitar_de_lector(id_mensaje, destinatario, (producto, remitente))
+    lector['eliminados'] = eliminados
+    lector['firma_eliminados'] = firma
+
+
+def _leer_no_leidos_csv():
+    try:
+        with open(RUTA_NO_LEIDOS_CSV, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _guardar_no_leidos_csv(no_leidos):
+    temporal = f"{RUTA_NO_LEIDOS_CSV}.{os.getpid()}.tmp"
+    with open(temporal, 'w', encoding='utf-8') as file:
+        json.dump(no_leidos, file)
+    os.replace(temporal, RUTA_NO_LEIDOS_CSV)
+
+
+def _leer_eliminados_csv():
+    try:
+        with open(RUTA_ELIMINADOS_CSV, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return []
+
+
+def _guardar_eliminados_csv(eliminados):
+    temporal = f"{RUTA_ELIMINADOS_CSV}.{os.getpid()}.tmp"
+    with open(temporal, 'w', encoding='utf-8') as file:
+        json.dump(eliminados, file)
+    os.replace(temporal, RUTA_ELIMINADOS_CSV)
+
+
+def _guardar_csv(fila):
+    with _bloqueo, bloqueo_fichero(RUTA_CSV_MENSAJES):
+        if not os.path.exists(RUTA_CSV_MENSAJES):
+            with open(RUTA_CSV_MENSAJES, 'w', newline='', encoding='utf-8') as file:
+                writer = csv.writer(file)
+                writer.writerow(CABECERA_CSV)
+
+        _actualizar_lector_csv()
+        id_mensaje = len(_lector_csv['filas'])
+        with open(RUTA_CSV_MENSAJES, 'a', newline='', encoding='utf-8') as file:
+            writer = csv.writer(file)
+            writer.writerow(fila)
+        no_leidos = _leer_no_leidos_csv()
+        no_leidos.setdefault(fila[2], []).append(id_mensaje)
+        _guardar_no_leidos_csv(no_leidos)
+
+
+def _cargar_csv(usuario):
+    with _bloqueo:
+        _actualizar_lector_csv()
+        pendientes = {destinatario: set(ids) for destinatario, ids in _leer_no_leidos_csv().items()}
+        filas = _lector_csv['filas']
+        ids = list(_lector_csv['por_usuario'].get(usuario, ()))
+    # Ordenar los mensajes por fecha, del más reciente al más antiguo; en el mismo minuto, por
+    # identificador como el motor SQLite
+    ids.sort(key=lambda id_mensaje: (filas[id_mensaje][0], id_mensaje), reverse=True)
+    mensajes = []
+    for id_mensaje in ids:
+        row = filas[id_mensaje][1]
+        mensajes.append(row + [id_mensaje, id_mensaje not in pendientes.get(row[2], ())])
+    return mensajes
+
+
+def _cargar_hilos_csv(usuario, limite, desplazamiento):
+    with _bloqueo:
+        _actualizar_lector_csv()
+        pendientes = set(_leer_no_leidos_csv().get(usuario, ()))
+        filas = _lector_csv['filas']
+        hilos = sorted(_lector_csv['hilos'].get(usuario, {}).items(), key=lambda hilo: hilo[1][-1], reverse=True)
+    hilos = hilos[desplazamiento:desplazamiento + limite if limite is not None else None]
+    resultado = []
+    for (producto, interlocutor), ids in hilos:
+        fecha, remitente, _, _, mensaje = filas[ids[-1]][1]
+        resultado.append([producto, interlocutor, fecha, remitente, mensaje, len(ids),
+                          len(pendientes.intersection(ids))])
+    return resultado
+
+
+def _cargar_hilo_csv(usuario, producto, interlocutor, limite, desplazamiento):
+    with _bloqueo:
+        _actualizar_lector_csv()
+        pendientes = {destinatario: set(ids) for destinatario, ids in _leer_no_leidos_csv().items()}
+        filas = _lector_csv['filas']
+        ids = _lector_csv['hilos'].get(usuario, {}).get((producto, interlocutor), [])[::-1]
+    mensajes = []
+    for id_mensaje in ids[desplazamiento:desplazamiento + limite if limite is not None else None]:
+        row = filas[id_mensaje][1]
+        mensajes.append(row + [id_mensaje, id_mensaje not in pendientes.get(row[2], ())])
+    return mensajes
+
+
+def _marcar_hilo_leido_csv(usuario, producto, interlocutor):
+    with _bloqueo, bloqueo_fichero(RUTA_CSV_MENSAJES):
+        _actualizar_lector_csv()
+        del_hilo = set(_lector_csv['hilos'].get(usuario, {}).get((producto, interlocutor), ()))
+        no_leidos = _leer_no_leidos_csv()
+        pendientes = no_leidos.get(usuario, [])
+        if del_hilo.intersection(pendientes):
+            no_leidos[usuario] = [i for i in pendientes if i not in del_hilo]
+            _guardar_no_leidos_csv(no_leidos)
+
+
+def _eliminar_csv(id_mensaje):
+    with _bloqueo, bloqueo_fichero(RUTA_CSV_MENSAJES):
+        _actualizar_lector_csv()
+        filas = _lector_csv['filas']
+        if not 0 <= id_mensaje < len(filas) or not filas[id_mensaje] or id_mensaje in _lector_csv['eliminados']:
+            return
+        # La fila se queda en el fichero y solo se marca como eliminada
+        _guardar_eliminados_csv(_leer_eliminados_csv() + [id_mensaje])
+        _aplicar_eliminados_csv()
+        no_leidos = _leer_no_leidos_csv()
+        if any(id_mensaje in ids for ids in no_leidos.values()):
+            no_leidos = {usuario: [i for i in ids if i != id_mensaje] for usuario, ids in no_leidos.items()}
+            _guardar_no_leidos_csv(no_leidos)
+
+
+def _marcar_leido_csv(id_mensaje, usuario):
+    with _bloqueo, bloqueo_fichero(RUTA_CSV_MENSAJES):
+        no_leidos = _leer_no_leidos_csv()
+        if id_mensaje in no_leidos.get(usuario, []):
+            no_leidos[usuario].remove(id_mensaje)
+            _guardar_no_leidos_csv(no_leidos)
+
+
+# Ejecutar `python mensajes.py` para migrar mensajes.csv antes de arrancar la aplicación
+if __name__ == '__main__':
+    total = conectar().execute("SELECT COUNT(*) FROM mensajes").fetchone()[0]
+    print(f"Mensajes en {RUTA_BD_MENSAJES}: {total}")
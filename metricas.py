@@ -0,0 +1,181 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# Métricas de rendimiento: tiempos de las funciones críticas y contadores (aciertos de caché,
+# bytes descargados, filas leídas...). Se acumulan por proceso y, dentro de cada rerun de
+# Streamlit, también por rerun.
+ACTIVAS = os.getenv('WALLACORE_METRICAS', '1') == '1'
+# Si se indica, cada rerun añade una línea JSON con su resumen
+RUTA_JSONL = os.getenv('WALLACORE_METRICAS_JSONL')
+# Si se indica, tras cada rerun se reescribe ahí el formato de texto de Prometheus (textfile collector
+# de node_exporter). Admite {pid} para que cada proceso escriba su propio fichero.
+RUTA_PROMETHEUS = os.getenv('WALLACORE_METRICAS_PROMETHEUS')
+
+_bloqueo = threading.Lock()
+_proceso = {'tiempos': {}, 'contadores': {}, 'reruns': 0, 'inicio': time.time()}
+# Registro del rerun en curso; los hilos de trabajo lo heredan si se lanzan con copy_context()
+_rerun = contextvars.ContextVar('metricas_rerun', default=None)
+
+
+def _acumular_tiempo(registro, nombre, segundos):
+    tiempo = registro['tiempos'].get(nombre)
+    if tiempo is None:
+        tiempo = registro['tiempos'][nombre] = {'llamadas': 0, 'total_s': 0.0, 'max_s': 0.0}
+    tiempo['llamadas'] += 1
+    tiempo['total_s'] += segundos
+    tiempo['max_s'] = max(tiempo['max_s'], segundos)
+
+
+# Función para registrar la duración de una operación
+def registrar_tiempo(nombre, segundos):
+    if not ACTIVAS:
+        return
+    rerun = _rerun.get()
+    with _bloqueo:
+        _acumular_tiempo(_proceso, nombre, segundos)
+        if rerun is not None:
+            _acumular_tiempo(rerun, nombre, segundos)
+
+
+# Función para sumar a un contador
+def contar(nombre, cantidad=1):
+    if not ACTIVAS:
+        return
+    rerun = _rerun.get()
+    with _bloqueo:
+        _proceso['contadores'][nombre] = _proceso['contadores'].get(nombre, 0) + cantidad
+        if rerun is not None:
+            rerun['contadores'][nombre] = rerun['contadores'].get(nombre, 0) + cantidad
+
+
+# Función para medir un bloque de código: `with medir('catalogo.leer'): ...`
+@contextmanager
+def medir(nombre):
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        registrar_tiempo(nombre, time.perf_counter() - inicio)
+
+
+# Decorador para medir todas las llamadas a una función
+def cronometrar(nombre):
+    def decorador(funcion):
+        @wraps(funcion)
+        def envoltura(*args, **kwargs):
+            with medir(nombre):
+                return funcion(*args, **kwargs)
+        return envoltura
+    return decorador
+
+
+# Función para empezar a acumular las métricas de un rerun (al principio del script)
+def iniciar_rerun():
+    _rerun.set({'tiempos': {}, 'contadores': {}, 'inicio': time.perf_counter()})
+
+
+# Función para cerrar el rerun en curso (al final del script); devuelve su resumen y lo exporta.
+# interrumpido indica que el script no llegó al final (st.rerun(), st.stop() o una excepción).
+def terminar_rerun(pagina=None, interrumpido=False):
+    rerun = _rerun.get()
+    if rerun is None:
+        return None
+    _rerun.set(None)
+    duracion = time.perf_counter() - rerun['inicio']
+    registrar_tiempo('rerun', duracion)
+    with _bloqueo:
+        _proceso['reruns'] += 1
+        resumen = {
+            'fecha': time.time(),
+            'pid': os.getpid(),
+            'pagina': pagina,
+            'interrumpido': interrumpido,
+            'duracion_s': duracion,
+            'tiempos': {nombre: dict(tiempo) for nombre, tiempo in rerun['tiempos'].items()},
+            'contadores': dict(rerun['contadores']),
+        }
+    if ACTIVAS and RUTA_JSONL:
+        with open(RUTA_JSONL, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(resumen, ensure_ascii=False) + '\n')
+    if ACTIVAS and RUTA_PROMETHEUS:
+        ruta = RUTA_PROMETHEUS.format(pid=os.getpid())
+        temporal = f"{ruta}.{os.getpid()}.tmp"
+        with open(temporal, 'w', encoding='utf-8') as file:
+            file.write(a_prometheus())
+        os.replace(temporal, ruta)
+    return resumen
+
+
+# Función para obtener una copia de las métricas acumuladas por el proceso
+def resumen_proceso():
+    with _bloqueo:
+        return {
+            'fecha': time.time(),
+            'pid': os.getpid(),
+            'activo_s': time.time() - _proceso['inicio'],
+            'reruns': _proceso['reruns'],
+            'tiempos': {nombre: dict(tiempo) for nombre, tiempo in _proceso['tiempos'].items()},
+            'contadores': dict(_proceso['contadores']),
+        }
+
+
+# Función para pasar los tiempos a filas de tabla, de mayor a menor tiempo total
+def filas_tiempos(tiempos):
+    filas = [{
+        'operación': nombre,
+        'llamadas': tiempo['llamadas'],
+        'total ms': round(tiempo['total_s'] * 1000, 1),
+        'media ms': round(tiempo['total_s'] * 1000 / tiempo['llamadas'], 1),
+        'máx ms': round(tiempo['max_s'] * 1000, 1),
+    } for nombre, tiempo in tiempos.items()]
+    return sorted(filas, key=lambda fila: fila['total ms'], reverse=True)
+
+
+# Función para exportar las métricas del proceso como una línea JSON
+def a_jsonl():
+    return json.dumps(resumen_proceso(), ensure_ascii=False) + '\n'
+
+
+def _etiqueta(valor):
+    return valor.replace('\\', '\\\\').replace('"', '\\"')
+
+
+# Función para exportar las métricas del proceso en el formato de texto de Prometheus
+def a_prometheus():
+    resumen = resumen_proceso()
+    pid = resumen['pid']
+    lineas = [
+        '# HELP wallacore_reruns_total Reruns de Streamlit completados.',
+        '# TYPE wallacore_reruns_total counter',
+        f'wallacore_reruns_total{{pid="{pid}"}} {resumen["reruns"]}',
+        '# HELP wallacore_llamadas_total Llamadas a cada operación medida.',
+        '# TYPE wallacore_llamadas_total counter',
+    ]
+    for nombre, tiempo in sorted(resumen['tiempos'].items()):
+        lineas.append(f'wallacore_llamadas_total{{pid="{pid}",operacion="{_etiqueta(nombre)}"}} {tiempo["llamadas"]}')
+    lineas += [
+        '# HELP wallacore_tiempo_segundos_total Tiempo acumulado en cada operación medida.',
+        '# TYPE wallacore_tiempo_segundos_total counter',
+    ]
+    for nombre, tiempo in sorted(resumen['tiempos'].items()):
+        lineas.append(f'wallacore_tiempo_segundos_total{{pid="{pid}",operacion="{_etiqueta(nombre)}"}} '
+                      f'{tiempo["total_s"]:.6f}')
+    lineas += [
+        '# HELP wallacore_tiempo_maximo_segundos Duración máxima de cada operación medida.',
+        '# TYPE wallacore_tiempo_maximo_segundos gauge',
+    ]
+    for nombre, tiempo in sorted(resumen['tiempos'].items()):
+        lineas.append(f'wallacore_tiempo_maximo_segundos{{pid="{pid}",operacion="{_etiqueta(nombre)}"}} '
+                      f'{tiempo["max_s"]:.6f}')
+    lineas += [
+        '# HELP wallacore_eventos_total Contadores de la aplicación (aciertos de caché, bytes, filas...).',
+        '# TYPE wallacore_eventos_total counter',
+    ]
+    for nombre, valor in sorted(resumen['contadores'].items()):
+        lineas.append(f'wallacore_eventos_total{{pid="{pid}",contador="{_etiqueta(nombre)}"}} {valor}')
+    return '\n'.join(lineas) + '\n'
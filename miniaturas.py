@@ -0,0 +1,287 @@
+import contextvars
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import requests
+from PIL import Image
+from requests.adapters import HTTPAdapter
+
+from metricas import contar, cronometrar
+
+# Configuración de la descarga de miniaturas
+TAMAÑO_MINIATURA = (100, 100)
+HILOS_DESCARGA = int(os.getenv('WALLACORE_HILOS_MINIATURAS', '8'))
+TIEMPO_CONEXION = float(os.getenv('WALLACORE_TIMEOUT_CONEXION', '3'))
+TIEMPO_LECTURA = float(os.getenv('WALLACORE_TIMEOUT_LECTURA', '10'))
+
+# Configuración de la caché de miniaturas en disco
+DIRECTORIO_CACHE = os.getenv('WALLACORE_CACHE_MINIATURAS', os.path.join('.cache', 'miniaturas'))
+LIMITE_CACHE = int(os.getenv('WALLACORE_LIMITE_CACHE_MB', '50')) * 1024 * 1024
+FRESCURA_CACHE = int(os.getenv('WALLACORE_FRESCURA_MINIATURAS', '86400'))  # Segundos sin revalidar
+
+# Miniaturas generadas al publicar, guardadas junto al catálogo
+DIRECTORIO_MINIATURAS = os.getenv('WALLACORE_MINIATURAS', 'miniaturas')
+CALIDAD_WEBP = int(os.getenv('WALLACORE_CALIDAD_WEBP', '80'))
+# Reintentos de la generación ante fallos pasajeros (red, errores 5xx, disco)
+INTENTOS_MINIATURA = int(os.getenv('WALLACORE_INTENTOS_MINIATURA', '4'))
+ESPERA_MINIATURA = float(os.getenv('WALLACORE_ESPERA_MINIATURA', '10'))  # Segundos antes del primer reintento
+# Tras fallar la descarga (servidor caído o inalcanzable) no se vuelve a pedir la foto durante este tiempo
+ESPERA_CAIDA = int(os.getenv('WALLACORE_ESPERA_CAIDA', '3600'))
+
+# Sesión HTTP y pool de hilos compartidos por todas las sesiones de Streamlit del proceso
+_sesion = None
+_bloqueo_sesion = threading.Lock()
+_ejecutor = ThreadPoolExecutor(max_workers=HILOS_DESCARGA, thread_name_prefix='miniaturas')
+_bloqueo_cache = threading.Lock()
+_tamaño_cache = None
+_ejecutor_publicacion = ThreadPoolExecutor(max_workers=2, thread_name_prefix='publicacion')
+
+
+# Función para obtener la sesión HTTP con conexiones keep-alive reutilizables
+def obtener_sesion():
+    global _sesion
+    if _sesion is None:
+        with _bloqueo_sesion:
+            if _sesion is None:
+                sesion = requests.Session()
+                adaptador = HTTPAdapter(pool_connections=HILOS_DESCARGA, pool_maxsize=HILOS_DESCARGA)
+                sesion.mount('http://', adaptador)
+                sesion.mount('https://', adaptador)
+                _sesion = sesion
+    return _sesion
+
+
+# Función para obtener las rutas de la miniatura y sus metadatos en la caché
+def _rutas_cache(url):
+    clave = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    base = os.path.join(DIRECTORIO_CACHE, clave)
+    return base + '.png', base + '.json'
+
+
+# Función para leer una miniatura de la caché, marcándola como usada recientemente
+def _leer_cache(url):
+    ruta_imagen, ruta_meta = _rutas_cache(url)
+    try:
+        with open(ruta_imagen, 'rb') as file:
+            datos = file.read()
+        with open(ruta_meta, 'r', encoding='utf-8') as file:
+            meta = json.load(file)
+        os.utime(ruta_imagen)
+        return datos, meta
+    except (OSError, ValueError):
+        return None
+
+
+# Función para escribir un fichero de la caché de forma atómica
+def _escribir_atomico(ruta, datos):
+    temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporal, 'wb') as file:
+        file.write(datos)
+    os.replace(temporal, ruta)
+
+
+# Función para guardar los metadatos de validación de una miniatura
+def _guardar_meta(url, meta):
+    _escribir_atomico(_rutas_cache(url)[1], json.dumps(meta).encode('utf-8'))
+
+
+# Función para guardar una miniatura en la caché y liberar espacio si se supera el límite
+def _guardar_cache(url, datos, meta):
+    global _tamaño_cache
+    os.makedirs(DIRECTORIO_CACHE, exist_ok=True)
+    ruta_imagen = _rutas_cache(url)[0]
+    _escribir_atomico(ruta_imagen, datos)
+    _guardar_meta(url, meta)
+    with _bloqueo_cache:
+        if _tamaño_cache is None:
+            _tamaño_cache = sum(e.stat().st_size for e in os.scandir(DIRECTORIO_CACHE) if e.name.endswith('.png'))
+        else:
+            _tamaño_cache += len(datos)
+        if _tamaño_cache > LIMITE_CACHE:
+            _tamaño_cache = _expulsar_antiguas()
+
+
+# Función para eliminar las miniaturas usadas hace más tiempo (LRU) hasta quedar bajo el límite
+def _expulsar_antiguas():
+    entradas = [e for e in os.scandir(DIRECTORIO_CACHE) if e.name.endswith('.png')]
+    entradas.sort(key=lambda e: e.stat().st_mtime)
+    total = sum(e.stat().st_size for e in entradas)
+    for entrada in entradas:
+        if total <= LIMITE_CACHE:
+            break
+        total -= entrada.stat().st_size
+        for ruta in (entrada.path, entrada.path[:-len('.png')] + '.json'):
+            try:
+                os.remove(ruta)
+            except OSError:
+                pass
+    return total
+
+
+# Función para reducir una imagen descargada a miniatura y codificarla en PNG
+def _crear_miniatura(contenido):
+    img = Image.open(BytesIO(contenido))
+    img.thumbnail(TAMAÑO_MINIATURA)
+    if img.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+        img = img.convert('RGB')
+    salida = BytesIO()
+    img.save(salida, format='PNG')
+    return salida.getvalue()
+
+
+# Función para obtener las rutas de la miniatura publicada, de su marca de imagen rota (permanente)
+# y de su marca de servidor caído (caduca a los ESPERA_CAIDA segundos)
+def _rutas_publicadas(url):
+    clave = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    base = os.path.join(DIRECTORIO_MINIATURAS, clave)
+    return base + '.webp', base + '.rota', base + '.caida'
+
+
+def _marcar_caida(ruta_caida, error):
+    try:
+        os.makedirs(DIRECTORIO_MINIATURAS, exist_ok=True)
+        _escribir_atomico(ruta_caida, repr(error).encode('utf-8'))
+    except OSError:
+        pass
+
+
+def _caida_reciente(ruta_caida):
+    try:
+        return time.time() - os.path.getmtime(ruta_caida) < ESPERA_CAIDA
+    except OSError:
+        return False
+
+
+# Función para descargar, validar y guardar la miniatura de un producto recién publicado.
+# Solo se marca la imagen como rota si la URL no existe (4xx) o lo descargado no es una imagen;
+# los fallos pasajeros se reintentan más tarde y, mientras tanto, se descarga al mostrarla.
+@cronometrar('miniaturas.generar')
+def generar_miniatura(url, intento=1):
+    ruta_imagen, ruta_rota, ruta_caida = _rutas_publicadas(url)
+    try:
+        os.makedirs(DIRECTORIO_MINIATURAS, exist_ok=True)
+        response = obtener_sesion().get(url, timeout=(TIEMPO_CONEXION, TIEMPO_LECTURA))
+        if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+            _escribir_atomico(ruta_rota, f"HTTP {response.status_code}".encode('utf-8'))
+            return False
+        response.raise_for_status()
+        contar('miniaturas.bytes_descargados', len(response.content))
+        try:
+            Image.open(BytesIO(response.content)).verify()
+            img = Image.open(BytesIO(response.content))
+            img.thumbnail(TAMAÑO_MINIATURA)
+            if img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB')
+        except Exception as e:
+            # Se guarda el motivo para no volver a intentarlo al mostrar el catálogo
+            _escribir_atomico(ruta_rota, str(e).encode('utf-8'))
+            return False
+        salida = BytesIO()
+        img.save(salida, format='WEBP', quality=CALIDAD_WEBP)
+        _escribir_atomico(ruta_imagen, salida.getvalue())
+        for ruta in (ruta_rota, ruta_caida):
+            if os.path.exists(ruta):
+                os.remove(ruta)
+        return True
+    except (requests.RequestException, OSError) as e:
+        if intento >= INTENTOS_MINIATURA:
+            # Sin más reintentos: se marca para que al mostrar el catálogo no se pida en cada rerun
+            _marcar_caida(ruta_caida, e)
+        else:
+            contar('miniaturas.reintentos')
+            espera = threading.Timer(ESPERA_MINIATURA * 2 ** (intento - 1), _ejecutor_publicacion.submit,
+                                     (generar_miniatura, url, intento + 1))
+            espera.daemon = True
+            espera.start()
+        return False
+
+
+# Función para encolar la generación de la miniatura sin bloquear la publicación
+def encolar_miniatura(url):
+    if not isinstance(url, str) or not url.strip():
+        return None
+    return _ejecutor_publicacion.submit(generar_miniatura, url)
+
+
+# Función para redimensionar la imagen, sirviéndola desde la caché en disco siempre que se pueda
+@cronometrar('miniaturas.redimensionar')
+def redimensionar_imagen(url, marcador=None):
+    if not isinstance(url, str) or not url.strip():
+        return marcador
+
+    # Primero la miniatura generada al publicar; si la imagen está rota no se reintenta
+    ruta_publicada, ruta_rota, ruta_caida = _rutas_publicadas(url)
+    try:
+        with open(ruta_publicada, 'rb') as file:
+            imagen = Image.open(BytesIO(file.read()))
+        contar('miniaturas.publicadas')
+        return imagen
+    except OSError:
+        if os.path.exists(ruta_rota):
+            contar('miniaturas.rotas')
+            return marcador
+
+    en_cache = _leer_cache(url)
+    try:
+        if en_cache and time.time() - en_cache[1].get('validado', 0) < FRESCURA_CACHE:
+            contar('miniaturas.cache_aciertos')
+            return Image.open(BytesIO(en_cache[0]))
+        if _caida_reciente(ruta_caida):
+            # La última descarga falló hace poco: se sirve lo que haya sin volver a esperar al servidor
+            contar('miniaturas.caidas')
+            return Image.open(BytesIO(en_cache[0])) if en_cache else marcador
+
+        # Revalidar con ETag/Last-Modified en lugar de volver a descargar
+        cabeceras = {}
+        if en_cache and en_cache[1].get('etag'):
+            cabeceras['If-None-Match'] = en_cache[1]['etag']
+        if en_cache and en_cache[1].get('last_modified'):
+            cabeceras['If-Modified-Since'] = en_cache[1]['last_modified']
+        response = obtener_sesion().get(url, headers=cabeceras, timeout=(TIEMPO_CONEXION, TIEMPO_LECTURA))
+        contar('miniaturas.peticiones')
+        if response.status_code == 304 and en_cache:
+            contar('miniaturas.revalidadas')
+            en_cache[1]['validado'] = time.time()
+            _guardar_meta(url, en_cache[1])
+            return Image.open(BytesIO(en_cache[0]))
+        response.raise_for_status()
+        contar('miniaturas.bytes_descargados', len(response.content))
+
+        datos = _crear_miniatura(response.content)
+        meta = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'validado': time.time(),
+        }
+        try:
+            _guardar_cache(url, datos, meta)
+        except OSError:
+            pass  # Sin caché en disco la miniatura se sigue sirviendo
+        return Image.open(BytesIO(datos))
+    except Exception as e:
+        contar('miniaturas.errores')
+        if isinstance(e, requests.RequestException):
+            _marcar_caida(ruta_caida, e)
+        # Si el servidor no responde, mejor una miniatura caducada que ninguna
+        if en_cache:
+            try:
+                return Image.open(BytesIO(en_cache[0]))
+            except Exception:
+                pass
+        return marcador
+
+
+# Función para descargar en paralelo las miniaturas de una lista de URLs, en el mismo orden
+def cargar_miniaturas(urls, marcador=None):
+    urls = list(urls)
+    pendientes = {}
+    for url in urls:
+        if isinstance(url, str) and url not in pendientes:
+            # Cada descarga hereda el contexto del rerun para que sus métricas cuenten en él
+            pendientes[url] = _ejecutor.submit(contextvars.copy_context().run, redimensionar_imagen, url, marcador)
+    return [pendientes[url].result() if url in pendientes else marcador for url in urls]
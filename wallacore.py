@@ -1,12 +1,16 @@
 import streamlit as st
-import pandas as pd
-import csv
-from PIL import Image
-import requests
-from io import BytesIO
-import pyperclip
-from datetime import datetime
 import os
+from mensajes import enviar_mensaje, eliminar_mensaje, contar_mensajes_no_leidos, contar_mensajes_por_producto, \
+    cargar_hilos, contar_hilos, cargar_hilo, marcar_hilo_leido
+from metricas import iniciar_rerun, terminar_rerun, resumen_proceso, filas_tiempos, a_jsonl, a_prometheus
+from arranque import iniciar_calentamiento, informe_arranque
+
+PRODUCTOS_POR_PAGINA = int(os.getenv('WALLACORE_PRODUCTOS_POR_PAGINA', '20'))
+MENSAJES_POR_PAGINA = int(os.getenv('WALLACORE_MENSAJES_POR_PAGINA', '20'))
+# Usuarios que ven el panel de rendimiento, separados por comas
+ADMINISTRADORES = [usuario.strip() for usuario in os.getenv('WALLACORE_ADMINISTRADORES', '').split(',') if usuario.strip()]
+
+iniciar_rerun()
 
 def verificar_credenciales(usuario, password):
     if usuario in st.secrets:
@@ -14,218 +18,261 @@ def verificar_credenciales(usuario, password):
             return True, st.secrets[usuario]["correo"]
     return False, None
 
-# Función para cargar el catálogo de productos
-def cargar_catalogo():
-    return pd.read_csv('catalogo.csv', encoding='utf-8')
+# Función para elegir la página de una lista; devuelve la posición de su primer elemento
+def seleccionar_pagina(clave, total, por_pagina, elementos):
+    if not por_pagina or total <= por_pagina:
+        return 0
+    paginas = (total + por_pagina - 1) // por_pagina
+    if st.session_state.get(clave, 1) > paginas:
+        st.session_state[clave] = paginas
+    pagina = st.number_input("Página", min_value=1, max_value=paginas, step=1, key=clave)
+    st.caption(f"Página {pagina} de {paginas} ({total} {elementos})")
+    return (pagina - 1) * por_pagina
 
-# Función para redimensionar la imagen
-def redimensionar_imagen(url):
-    try:
-        response = requests.get(url)
-        img = Image.open(BytesIO(response.content))
-        img.thumbnail((100, 100))
-        return img
-    except:
-        return None
 
 # Función para mostrar la lista de productos
-def mostrar_productos(df, titulo, es_mis_productos=False):
+def mostrar_productos(df, titulo, es_mis_productos=False, por_pagina=PRODUCTOS_POR_PAGINA, mensajes=None):
     st.header(titulo)
+
+    # Solo se crean los widgets de la página actual
+    inicio = seleccionar_pagina(f"pagina_{titulo}", len(df), por_pagina, "productos")
+    if por_pagina:
+        df = df.iloc[inicio:inicio + por_pagina]
+
+    # Solo se descargan las fotos de los productos con el desplegable abierto
+    abiertos = [index for index in df.index if st.session_state.get(f"producto_{index}")]
+    miniaturas = dict(zip(abiertos, cargar_miniaturas(df.loc[abiertos, 'Foto'].tolist())))
     for index, row in df.iterrows():
-        with st.expander(f"{row['Producto']} - {row['Precio']}€"):
+        with st.expander(f"{row['Producto']} - {row['Precio']}€", key=f"producto_{index}", on_change="rerun"):
             st.write(f"Vendedor: {row['Vendedor']}")
             st.write(f"Descripción: {row['Descripción']}")
-            img = redimensionar_imagen(row['Foto'])
-            if img:
-                st.image(img, caption=row['Producto'])
-            else:
-                st.write("No se pudo cargar la imagen")
+            if index in miniaturas:
+                if miniaturas[index]:
+                    st.image(miniaturas[index], caption=row['Producto'])
+                else:
+                    st.write("No se pudo cargar la imagen")
             
             if not es_mis_productos:
                 col1, col2 = st.columns(2)
-                if col1.button(f"Copiar correo del vendedor {index}"):
-                    pyperclip.copy(row['Correo Vendedor'])
-                    st.success("Correo copiado al portapapeles")
-                if col2.button(f"Enviar mensaje al vendedor {index}"):
+                if col1.button("Copiar correo del vendedor", key=f"copiar_{index}"):
+                    try:
+                        import pyperclip  # Solo sirve si el servidor tiene portapapeles (uso en local)
+                        pyperclip.copy(row['Correo Vendedor'])
+                        st.success("Correo copiado al portapapeles")
+                    except (ImportError, RuntimeError):
+                        # En un servidor sin pantalla se muestra el correo con el botón de copiar del navegador
+                        st.code(row['Correo Vendedor'], language=None)
+                if col2.button("Enviar mensaje al vendedor", key=f"contactar_{index}"):
                     st.session_state.producto_seleccionado = row['Producto']
                     st.session_state.vendedor_seleccionado = row['Vendedor']
                     st.session_state.correo_vendedor = row['Correo Vendedor']
                     #st.experimental_rerun()
                     st.rerun()
             else:
-                if st.button(f"Eliminar producto {index}"):
+                if mensajes is not None:
+                    st.write(f"Mensajes recibidos: {mensajes.get(row['Producto'], 0)}")
+                if st.button("Eliminar producto", key=f"eliminar_{index}"):
                     eliminar_producto(index)
                     #st.experimental_rerun()
                     st.rerun()
 
-# Función para añadir un nuevo producto
-def añadir_producto(vendedor, correo, producto, descripcion, foto, precio):
-    with open('catalogo.csv', 'a', newline='', encoding='utf-8') as file:
-        writer = csv.writer(file)
-        writer.writerow([vendedor, correo, producto, descripcion, foto, precio])
-
-# Función para eliminar un producto
-def eliminar_producto(index):
-    df = cargar_catalogo()
-    df = df.drop(index)
-    df.to_csv('catalogo.csv', index=False, encoding='utf-8')
-
-# Función para enviar un mensaje
-def enviar_mensaje(remitente, destinatario, producto, mensaje):
-    if not os.path.exists('mensajes.csv'):
-        with open('mensajes.csv', 'w', newline='', encoding='utf-8') as file:
-            writer = csv.writer(file)
-            writer.writerow(['fecha', 'remitente', 'destinatario', 'producto', 'mensaje'])
-    
-    with open('mensajes.csv', 'a', newline='', encoding='utf-8') as file:
-        writer = csv.writer(file)
-        writer.writerow([datetime.now().strftime("%Y-%m-%d %H:%M"), remitente, destinatario, producto, mensaje])
-
-# Función para cargar los mensajes de un usuario
-def cargar_mensajes(usuario):
-    mensajes = []
-    if os.path.exists('mensajes.csv'):
-        with open('mensajes.csv', 'r', encoding='utf-8') as file:
-            reader = csv.reader(file)
-            next(reader)  # Saltar la fila de encabezados
-            for row in reader:
-                if row[1] == usuario or row[2] == usuario:  # Si el usuario es el remitente o el destinatario
-                    mensajes.append(row)
-    # Ordenar los mensajes por fecha, del más reciente al más antiguo
-    mensajes.sort(key=lambda x: datetime.strptime(x[0], "%Y-%m-%d %H:%M"), reverse=True)
-    return mensajes
-
-# Función para eliminar un mensaje
-def eliminar_mensaje(index):
-    df = pd.read_csv('mensajes.csv')
-    df = df.drop(index)
-    df.to_csv('mensajes.csv', index=False, encoding='utf-8')
-
-# Función para contar mensajes no leídos
-def contar_mensajes_no_leidos(usuario):
-    mensajes = cargar_mensajes(usuario)
-    return len([m for m in mensajes if m[2] == usuario])
-
-# Configuración de la página
-st.set_page_config(page_title="Wallacore", layout="wide")
-
-# Inicialización de la sesión
-if 'logged_in' not in st.session_state:
-    st.session_state.logged_in = False
-    st.session_state.usuario = None
-    st.session_state.correo = None
-    st.session_state.producto_seleccionado = None
-    st.session_state.vendedor_seleccionado = None
-    st.session_state.correo_vendedor = None
-
-# Página de inicio de sesión
-if not st.session_state.logged_in:
-    st.title("Bienvenido a Wallacore")
-    usuario = st.text_input("Usuario")
-    password = st.text_input("Contraseña", type="password")
-    if st.button("Iniciar sesión"):
-        verificado, correo = verificar_credenciales(usuario, password)
-        if verificado:
-            st.session_state.logged_in = True
-            st.session_state.usuario = usuario
-            st.session_state.correo = correo
-            st.success("Inicio de sesión exitoso")
+# Función para mostrar la bandeja de entrada: una fila por conversación, la más reciente primero
+def mostrar_bandeja(por_pagina=MENSAJES_POR_PAGINA):
+    total = contar_hilos(st.session_state.correo)
+    if not total:
+        st.write("No se han encontrado mensajes")
+        return
+    inicio = seleccionar_pagina("pagina_bandeja", total, por_pagina, "conversaciones")
+    for hilo in cargar_hilos(st.session_state.correo, por_pagina or None, inicio):
+        producto, interlocutor, fecha, remitente, mensaje, _, no_leidos = hilo
+        col1, col2 = st.columns([4, 1])
+        titulo = f"Mensajes sobre {producto} con {interlocutor}"
+        if no_leidos:
+            titulo = f"🔵 {titulo} ({no_leidos} nuevos)"
+        col1.write(titulo)
+        col1.caption(f"{fecha} - {'Tú' if remitente == st.session_state.correo else remitente}: {mensaje}")
+        if col2.button("Abrir", key=f"abrir_{producto}_{interlocutor}"):
+            # Abrir una conversación marca como leídos sus mensajes recibidos
+            marcar_hilo_leido(st.session_state.correo, producto, interlocutor)
+            st.session_state.hilo_abierto = (producto, interlocutor)
+            st.session_state.mensajes_visibles = por_pagina
             #st.experimental_rerun()
             st.rerun()
+
+
+# Función para mostrar una conversación; los mensajes anteriores se cargan página a página
+def mostrar_hilo(producto, interlocutor, por_pagina=MENSAJES_POR_PAGINA):
+    if st.button("Volver a mis mensajes"):
+        st.session_state.hilo_abierto = None
+        #st.experimental_rerun()
+        st.rerun()
+    st.subheader(f"Mensajes sobre {producto} con {interlocutor}")
+
+    with st.form("responder", clear_on_submit=True):
+        respuesta = st.text_area("Escribe tu respuesta")
+        if st.form_submit_button("Enviar respuesta") and respuesta:
+            enviar_mensaje(st.session_state.correo, interlocutor, producto, respuesta)
+            st.success("Respuesta enviada con éxito")
+
+    # Se pide un mensaje de más para saber si quedan mensajes anteriores
+    visibles = st.session_state.get('mensajes_visibles') or por_pagina
+    mensajes = cargar_hilo(st.session_state.correo, producto, interlocutor, visibles + 1)
+    for fecha, remitente, _, _, mensaje, id_mensaje, _ in mensajes[:visibles]:
+        es_enviado = remitente == st.session_state.correo
+        with st.container(border=True):
+            st.caption(f"{fecha} - {'Tú' if es_enviado else remitente}")
+            st.write(mensaje)
+            if not es_enviado:  # Solo se pueden eliminar los mensajes recibidos
+                if st.button("Eliminar mensaje", key=f"eliminar_mensaje_{id_mensaje}"):
+                    eliminar_mensaje(id_mensaje)
+                    #st.experimental_rerun()
+                    st.rerun()
+    if len(mensajes) > visibles:
+        if st.button("Cargar mensajes anteriores"):
+            st.session_state.mensajes_visibles = visibles + por_pagina
+            #st.experimental_rerun()
+            st.rerun()
+
+
+# Función para mostrar en la barra lateral los tiempos del rerun y los acumulados del proceso
+def mostrar_panel_rendimiento(resumen):
+    with st.sidebar.expander("Rendimiento"):
+        st.write(f"Este rerun: {resumen['duracion_s'] * 1000:.0f} ms")
+        st.dataframe(filas_tiempos(resumen['tiempos']), hide_index=True)
+        st.json(resumen['contadores'], expanded=False)
+        proceso = resumen_proceso()
+        st.write(f"Proceso {proceso['pid']}: {proceso['reruns']} reruns")
+        st.dataframe(filas_tiempos(proceso['tiempos']), hide_index=True)
+        st.json(proceso['contadores'], expanded=False)
+        st.download_button("Exportar JSON lines", a_jsonl(), file_name="metricas.jsonl")
+        st.download_button("Exportar Prometheus", a_prometheus(), file_name="metricas.prom")
+        arranque = informe_arranque()
+        if arranque.get('calentamiento_s') is not None:
+            st.write(f"Arranque: calentado en {arranque['calentamiento_s']:.2f} s")
         else:
-            st.error("Usuario o contraseña incorrectos")
-
-# Página principal después del inicio de sesión
-else:
-    st.sidebar.title(f"Bienvenido, {st.session_state.usuario}")
-    mensajes_no_leidos = contar_mensajes_no_leidos(st.session_state.correo)
-    menu = st.sidebar.radio("Menú", [
-        "Lista de productos", 
-        "Mis productos", 
-        "Poner producto a la venta", 
-        f"Mis mensajes ({mensajes_no_leidos} nuevos)" if mensajes_no_leidos > 0 else "Mis mensajes"
-    ])
-
-    if menu == "Lista de productos":
-        if st.session_state.producto_seleccionado:
-            st.subheader(f"Enviar mensaje sobre: {st.session_state.producto_seleccionado}")
-            mensaje = st.text_area("Escribe tu mensaje")
-            if st.button("Enviar mensaje"):
-                enviar_mensaje(st.session_state.correo, st.session_state.correo_vendedor, st.session_state.producto_seleccionado, mensaje)
-                st.success("Mensaje enviado con éxito")
-                st.session_state.producto_seleccionado = None
-                st.session_state.vendedor_seleccionado = None
-                st.session_state.correo_vendedor = None
-                #st.experimental_rerun()
-                st.rerun()
-        else:
-            df = cargar_catalogo()
-            mostrar_productos(df, "Productos disponibles")
-
-    elif menu == "Mis productos":
-        df = cargar_catalogo()
-        mis_productos = df[df['Correo Vendedor'] == st.session_state.correo]
-        mostrar_productos(mis_productos, "Mis productos a la venta", es_mis_productos=True)
-
-    elif menu == "Poner producto a la venta":
-        st.header("Poner producto a la venta")
-        producto = st.text_input("Nombre del producto")
-        descripcion = st.text_area("Descripción")
-        foto = st.text_input("URL de la foto")
-        precio = st.number_input("Precio (€)", min_value=0.0, step=0.01)
-        if st.button("Publicar producto"):
-            añadir_producto(st.session_state.usuario, st.session_state.correo, producto, descripcion, foto, precio)
-            st.success("Producto añadido con éxito")
-
-    elif menu.startswith("Mis mensajes"):
-        st.header("Mis mensajes")
-        mensajes = cargar_mensajes(st.session_state.correo)
-        if not mensajes:
-            st.write("No se han encontrado mensajes")
-        else:
-            for index, mensaje in enumerate(mensajes):
-                es_enviado = mensaje[1] == st.session_state.correo
-                tipo_mensaje = "Enviado" if es_enviado else "Recibido"
-                
-                titulo = f"{tipo_mensaje}: Mensaje sobre {mensaje[3]} {'para' if es_enviado else 'de'} {mensaje[2] if es_enviado else mensaje[1]}"
-                
-                with st.expander(titulo):
-                    st.write(f"Fecha: {mensaje[0]}")
-                    st.write(f"{'Para' if es_enviado else 'De'}: {mensaje[2] if es_enviado else mensaje[1]}")
-                    st.write(f"Producto: {mensaje[3]}")
-                    st.write(f"Mensaje: {mensaje[4]}")
-                    
-                    if not es_enviado:  # Solo mostrar opciones para mensajes recibidos
-                        col1, col2 = st.columns(2)
-                        if col1.button(f"Eliminar mensaje {index}"):
-                            eliminar_mensaje(index)
-                            #st.experimental_rerun()
-                            st.rerun()
-                        if col2.button(f"Responder mensaje {index}"):
-                            st.session_state.respondiendo_mensaje = index
-                            st.session_state.destinatario_respuesta = mensaje[1]
-                            st.session_state.producto_respuesta = mensaje[3]
-                            #st.experimental_rerun()
-                            st.rerun()
-
-        if hasattr(st.session_state, 'respondiendo_mensaje'):
-            st.subheader(f"Responder al mensaje sobre: {st.session_state.producto_respuesta}")
-            respuesta = st.text_area("Escribe tu respuesta")
-            if st.button("Enviar respuesta"):
-                enviar_mensaje(st.session_state.correo, st.session_state.destinatario_respuesta, st.session_state.producto_respuesta, respuesta)
-                st.success("Respuesta enviada con éxito")
-                del st.session_state.respondiendo_mensaje
-                del st.session_state.destinatario_respuesta
-                del st.session_state.producto_respuesta
-                #st.experimental_rerun()
-                st.rerun()
+            st.write(f"Arranque: {arranque['estado']}")
+        st.json(arranque, expanded=False)
+
+
+# st.rerun() y st.stop() interrumpen el script con una excepción; el finally cierra igualmente
+# las métricas del rerun para que los reruns interrumpidos también se registren y exporten
+interrumpido = True
+try:
+    # Configuración de la página
+    st.set_page_config(page_title="Wallacore", layout="wide")
 
-    if st.sidebar.button("Cerrar sesión"):
+    # Inicialización de la sesión
+    if 'logged_in' not in st.session_state:
         st.session_state.logged_in = False
         st.session_state.usuario = None
         st.session_state.correo = None
         st.session_state.producto_seleccionado = None
         st.session_state.vendedor_seleccionado = None
         st.session_state.correo_vendedor = None
-        #st.experimental_rerun()
-        st.rerun()
+        st.session_state.hilo_abierto = None
+
+    # Página de inicio de sesión
+    if not st.session_state.logged_in:
+        st.title("Bienvenido a Wallacore")
+        usuario = st.text_input("Usuario")
+        password = st.text_input("Contraseña", type="password")
+        if st.button("Iniciar sesión"):
+            verificado, correo = verificar_credenciales(usuario, password)
+            if verificado:
+                st.session_state.logged_in = True
+                st.session_state.usuario = usuario
+                st.session_state.correo = correo
+                st.success("Inicio de sesión exitoso")
+                #st.experimental_rerun()
+                st.rerun()
+            else:
+                st.error("Usuario o contraseña incorrectos")
+
+    # Página principal después del inicio de sesión
+    else:
+        # Los módulos con dependencias pesadas (pandas, PIL, requests) se importan aquí y no al principio:
+        # la página de inicio de sesión no los necesita y un proceso nuevo la sirve sin esperar por ellos
+        from miniaturas import cargar_miniaturas
+        from catalogo import cargar_catalogo, añadir_producto, eliminar_producto
+        from busqueda import ORDENES, buscar, listar_vendedores, productos_de_vendedor
+
+        st.sidebar.title(f"Bienvenido, {st.session_state.usuario}")
+        mensajes_no_leidos = contar_mensajes_no_leidos(st.session_state.correo)
+        # Las opciones no cambian con el contador para que leer un mensaje no reinicie el menú
+        menu = st.sidebar.radio("Menú", [
+            "Lista de productos", 
+            "Mis productos", 
+            "Poner producto a la venta", 
+            "Mis mensajes"
+        ], key="menu", format_func=lambda opcion: f"Mis mensajes ({mensajes_no_leidos} nuevos)" if opcion == "Mis mensajes" and mensajes_no_leidos > 0 else opcion)
+
+        if menu == "Lista de productos":
+            if st.session_state.producto_seleccionado:
+                st.subheader(f"Enviar mensaje sobre: {st.session_state.producto_seleccionado}")
+                mensaje = st.text_area("Escribe tu mensaje")
+                if st.button("Enviar mensaje"):
+                    enviar_mensaje(st.session_state.correo, st.session_state.correo_vendedor, st.session_state.producto_seleccionado, mensaje)
+                    st.success("Mensaje enviado con éxito")
+                    st.session_state.producto_seleccionado = None
+                    st.session_state.vendedor_seleccionado = None
+                    st.session_state.correo_vendedor = None
+                    #st.experimental_rerun()
+                    st.rerun()
+            else:
+                texto = st.text_input("Buscar productos")
+                with st.expander("Filtros"):
+                    col1, col2 = st.columns(2)
+                    precio_min = col1.number_input("Precio mínimo (€)", min_value=0.0, step=1.0, value=None)
+                    precio_max = col2.number_input("Precio máximo (€)", min_value=0.0, step=1.0, value=None)
+                    vendedor = st.selectbox("Vendedor", listar_vendedores(), index=None, placeholder="Todos")
+                    orden = st.selectbox("Ordenar por", list(ORDENES), format_func=ORDENES.get)
+                if texto or precio_min is not None or precio_max is not None or vendedor or orden != 'publicacion':
+                    # Las filas salen del mismo índice que los IDs: un catálogo cargado aparte podría no tenerlos
+                    df = buscar(texto, precio_min, precio_max, vendedor, orden, filas=True)
+                else:
+                    df = cargar_catalogo()
+                mostrar_productos(df, "Productos disponibles")
+
+        elif menu == "Mis productos":
+            mis_productos = productos_de_vendedor(st.session_state.correo, filas=True)
+            recibidos = contar_mensajes_por_producto(st.session_state.correo)
+            col1, col2 = st.columns(2)
+            col1.metric("Productos a la venta", len(mis_productos))
+            col2.metric("Mensajes recibidos", sum(recibidos.get(producto, 0) for producto in set(mis_productos['Producto'])))
+            mostrar_productos(mis_productos, "Mis productos a la venta", es_mis_productos=True, mensajes=recibidos)
+
+        elif menu == "Poner producto a la venta":
+            st.header("Poner producto a la venta")
+            producto = st.text_input("Nombre del producto")
+            descripcion = st.text_area("Descripción")
+            foto = st.text_input("URL de la foto")
+            precio = st.number_input("Precio (€)", min_value=0.0, step=0.01)
+            if st.button("Publicar producto"):
+                añadir_producto(st.session_state.usuario, st.session_state.correo, producto, descripcion, foto, precio)
+                st.success("Producto añadido con éxito")
+
+        elif menu.startswith("Mis mensajes"):
+            st.header("Mis mensajes")
+            if st.session_state.get('hilo_abierto'):
+                mostrar_hilo(*st.session_state.hilo_abierto)
+            else:
+                mostrar_bandeja()
+
+        if st.sidebar.button("Cerrar sesión"):
+            st.session_state.logged_in = False
+            st.session_state.usuario = None
+            st.session_state.correo = None
+            st.session_state.producto_seleccionado = None
+            st.session_state.vendedor_seleccionado = None
+            st.session_state.correo_vendedor = None
+            st.session_state.hilo_abierto = None
+            #st.experimental_rerun()
+            st.rerun()
+    interrumpido = False
+finally:
+    # Métricas del rerun; los administradores las ven en la barra lateral
+    resumen_rerun = terminar_rerun(st.session_state.get('menu'), interrumpido)
+# El calentamiento empieza cuando la primera página ya está servida, para no competir con ella
+iniciar_calentamiento()
+if st.session_state.usuario in ADMINISTRADORES:
+    mostrar_panel_rendimiento(resumen_rerun)